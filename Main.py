@@ -1,626 +1,122 @@
-import datetime, time, json, sqlite3
-import os
-import platform
-import random
-import shutil
-
-import requests, webbrowser, urllib.parse
-from pathlib import Path
-from flask import Flask, render_template, request, redirect, url_for
-
-from selenium import webdriver
-from selenium.common import TimeoutException
-from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.action_chains import ActionChains
+import csv
+import datetime
+import io
+import json
+import sqlite3
+
+from flask import Flask, Response, render_template, request, redirect, url_for, jsonify, abort, g, stream_with_context
+
+import db
+import jobs
+import metrics
+import reconcile
+# the route functions are called sync() and push(), so the modules get longer names
+import push as plex_push
+import sync as trakt_sync
 
 app = Flask(__name__)
-
-DB_FILE = "trakt_plex.db"
-TOKEN_FILE = "trakt_token.json"
-API_KEYS = json.load(open("API_KEYS.json", "r"))
-CLIENT_ID = API_KEYS["Trakt_Client_ID"]
-CLIENT_SECRET = API_KEYS["Trakt_Client_Secret"]
-TOKEN = json.load(open(TOKEN_FILE))
-
-
-# ---------- DB SETUP ----------
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("""CREATE TABLE IF NOT EXISTS history (
-        history_id INTEGER PRIMARY KEY,     -- Trakt history event id
-        slug TEXT NOT NULL,                 -- trakt movie slug
-        imdb_id TEXT,
-        tmdb_id INTEGER,
-        title TEXT,
-        year INTEGER,
-        watched_at TEXT,
-        rated INTEGER DEFAULT 0,
-        rating INTEGER,
-        in_plex_history INTEGER DEFAULT 0,
-        in_plex_rating INTEGER DEFAULT 0
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS unrated (
-        slug TEXT PRIMARY KEY,
-        title TEXT
-    )""")
-    conn.commit()
+# sync and push work runs here instead of inside the request
+runner = jobs.JobRunner(max_workers=2)
+# pages only read, so they never queue behind a sync for the write lock
+read_pool = db.ConnectionPool(readonly=True)
+write_pool = db.ConnectionPool(max_idle=2)
+
+
+# ---------- REQUEST CONNECTIONS ----------
+def request_db(readonly=True):
+    """Connection for the current request, back to its pool when the request ends."""
+    attr = "db_ro" if readonly else "db_rw"
+    conn = g.get(attr)
+    if conn is None:
+        conn = (read_pool if readonly else write_pool).acquire()
+        setattr(g, attr, conn)
     return conn
 
-def db_conn():
-    return sqlite3.connect(DB_FILE)
-
-
-# ---------- OAUTH HELPERS ----------
-def get_trakt_token(client_id, client_secret):
-    """Run Trakt device flow and save token to file."""
-    r = requests.post("https://api.trakt.tv/oauth/device/code",
-                      json={"client_id": client_id})
-    r.raise_for_status()
-    device = r.json()
-    print(f"Go to {device['verification_url']} and enter code: {device['user_code']}")
-
-    while True:
-        time.sleep(device["interval"])
-        r = requests.post("https://api.trakt.tv/oauth/device/token", json={
-            "client_id": client_id,
-            "client_secret": client_secret,
-            "code": device["device_code"]
-        })
-        if r.status_code == 200:
-            token = r.json()
-            with open(TOKEN_FILE, "w") as f:
-                json.dump(token, f, indent=2)
-            print("Trakt authorization successful")
-            return token
-        elif r.status_code == 400:
-            # still pending
-            continue
-        elif r.status_code in (403, 404):
-            raise RuntimeError("Device code expired or invalid, restart flow")
-        else:
-            r.raise_for_status()
-
-
-def load_trakt_token(client_id, client_secret):
-    """Load access token from file or start new auth flow."""
-    if Path(TOKEN_FILE).exists():
-        with open(TOKEN_FILE, "r") as f:
-            return json.load(f)
-    return get_trakt_token(client_id, client_secret)
-
-
-def trakt_headers(client_id, access_token):
-    return {
-        "Content-Type": "application/json",
-        "trakt-api-version": "2",
-        "trakt-api-key": client_id,
-        "Authorization": f"Bearer {access_token}"
-    }
-
-
-# ---------- SYNC FUNCTIONS ----------
-
-def getAllHistory(headers):
-    """Fetch all Trakt history pages, not just recent watches."""
-    page = 1
-    per_page = 100
-    conn = init_db()
-    c = conn.cursor()
-
-    while True:
-        url = f"https://api.trakt.tv/sync/history/movies?page={page}&limit={per_page}"
-        r = requests.get(url, headers=headers)
-        r.raise_for_status()
-        data = r.json()
-        if not data:
-            break
-
-        for item in data:
-            h_id = item["id"]
-            m = item["movie"]
-            ids = m["ids"]
-
-            c.execute("""
-                INSERT OR IGNORE INTO history (
-                    history_id, slug, imdb_id, tmdb_id,
-                    title, year, watched_at
-                ) VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (
-                h_id,
-                ids["slug"],
-                ids.get("imdb"),
-                ids.get("tmdb"),
-                m["title"],
-                m["year"],
-                item["watched_at"]
-            ))
-
-        page += 1
-
-    conn.commit()
-    conn.close()
-
-
-def getHistory(headers):
-    url = "https://api.trakt.tv/sync/history/movies"
-    r = requests.get(url, headers=headers)
-    r.raise_for_status()
-    data = r.json()
-
-    conn = init_db()
-    c = conn.cursor()
-    for item in data:
-        h_id = item["id"]  # history event id
-        m = item["movie"]
-        ids = m["ids"]
-
-        c.execute("""
-            INSERT OR IGNORE INTO history (
-                history_id, slug, imdb_id, tmdb_id,
-                title, year, watched_at
-            ) VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (
-            h_id,
-            ids["slug"],
-            ids.get("imdb"),
-            ids.get("tmdb"),
-            m["title"],
-            m["year"],
-            item["watched_at"]
-        ))
-    conn.commit()
-    conn.close()
-
-
-def getHistoryRating(headers):
-    url = "https://api.trakt.tv/sync/ratings/movies"
-    r = requests.get(url, headers=headers)
-    r.raise_for_status()
-    ratings = r.json()
-
-    conn = init_db()
-    c = conn.cursor()
-    for r_item in ratings:
-        slug = r_item["movie"]["ids"]["slug"]
-        rating = r_item["rating"]
-        c.execute("UPDATE history SET rated=1, rating=? WHERE slug=?", (rating, slug))
-
-    c.execute("SELECT slug,title FROM history WHERE rated=0")
-    for slug, title in c.fetchall():
-        c.execute("INSERT OR IGNORE INTO unrated (slug, title) VALUES (?, ?)", (slug, title))
-    conn.commit()
-    conn.close()
-
-
-def rateUnratedFilms():
-    conn = init_db()
-    c = conn.cursor()
-    c.execute("SELECT slug,title FROM unrated")
-    films = c.fetchall()
-
-    for slug, title in films:
-        url = f"https://trakt.tv/movies/{slug}"
-        choice = input(f"Do you want to rate '{title}'? [y/N]: ").strip().lower()
-        if choice == "y":
-            print(f"Opening {url}")
-            webbrowser.open(url)
-            # TODO: Poll Trakt for rating update and update DB
-        else:
-            print(f"Skipped {title}")
-    conn.close()
-
-# ---------Plex-------------
-
-# from selenium.webdriver.chrome.service import Service as ChromeService
-# from selenium.webdriver.firefox.service import Service as FirefoxService
-# from selenium.webdriver.edge.service import Service as EdgeService
-# from selenium.webdriver.chrome.options import Options as ChromeOptions
-# from selenium.webdriver.firefox.options import Options as FirefoxOptions
-# from selenium.webdriver.edge.options import Options as EdgeOptions
-# from selenium.webdriver.safari.webdriver import WebDriver as SafariDriver
-#
-# def get_default_profile(browser):
-#     system = platform.system().lower()
-#     home = os.path.expanduser("~")
-#
-#     if browser == "chrome":
-#         if system == "windows":
-#             return os.path.join(os.environ["LOCALAPPDATA"], "Google/Chrome/User Data")
-#         elif system == "darwin":  # macOS
-#             return os.path.join(home, "Library/Application Support/Google/Chrome")
-#         else:  # Linux
-#             return os.path.join(home, ".config/google-chrome")
-#
-#     if browser == "brave":
-#         if system == "windows":
-#             return os.path.join(os.environ["LOCALAPPDATA"], "BraveSoftware/Brave-Browser/User Data")
-#         elif system == "darwin":
-#             return os.path.join(home, "Library/Application Support/BraveSoftware/Brave-Browser")
-#         else:
-#             return os.path.join(home, ".config/BraveSoftware/Brave-Browser")
-#
-#     if browser == "edge":
-#         if system == "windows":
-#             return os.path.join(os.environ["LOCALAPPDATA"], "Microsoft/Edge/User Data")
-#         elif system == "darwin":
-#             return os.path.join(home, "Library/Application Support/Microsoft Edge")
-#         else:
-#             return os.path.join(home, ".config/microsoft-edge")
-#
-#     if browser == "firefox":
-#         if system == "windows":
-#             return os.path.join(os.environ["APPDATA"], "Mozilla/Firefox/Profiles")
-#         elif system == "darwin":
-#             return os.path.join(home, "Library/Application Support/Firefox/Profiles")
-#         else:
-#             return os.path.join(home, ".mozilla/firefox")
-#
-#     return None
-#
-# def get_driver_auto():
-#     system = platform.system().lower()
-#
-#     # Try detecting default browser name
-#     try:
-#         default_browser = webbrowser.get().name.lower()
-#     except:
-#         default_browser = ""
-#
-#     candidates = [
-#         ("chrome", "chromedriver", ChromeService, ChromeOptions),
-#         ("brave", "chromedriver", ChromeService, ChromeOptions),
-#         ("firefox", "geckodriver", FirefoxService, FirefoxOptions),
-#         ("edge", "msedgedriver", EdgeService, EdgeOptions),
-#     ]
-#
-#     # if system == "darwin":
-#     #     candidates.append(("safari", None, None, None))
-#
-#     for browser_name, driver_cmd, service_cls, options_cls in candidates:
-#         if browser_name in default_browser:
-#             if browser_name == "safari":
-#                 print("Launching Safari (default browser)")
-#                 return SafariDriver()
-#             elif driver_cmd and shutil.which(driver_cmd):
-#                 print(f"Launching {browser_name} (default browser)")
-#                 options = options_cls()
-#
-#                 # Try to attach to existing user profile
-#                 profile_path = get_default_profile(browser_name)
-#                 if profile_path and os.path.exists(profile_path):
-#                     options.add_argument(f"user-data-dir={profile_path}")
-#                     print(f"Using profile: {profile_path}")
-#
-#                 if browser_name in ("chrome", "brave"):
-#                     return webdriver.Chrome(service=service_cls(), options=options)
-#                 elif browser_name == "firefox":
-#                     return webdriver.Firefox(service=service_cls(), options=options)
-#                 elif browser_name == "edge":
-#                     return webdriver.Edge(service=service_cls(), options=options)
-#
-#     # Fallback loop
-#     for browser_name, driver_cmd, service_cls, options_cls in candidates:
-#         if browser_name == "safari" and system == "darwin":
-#             print("Launching Safari (fallback)")
-#             return SafariDriver()
-#         elif driver_cmd and shutil.which(driver_cmd):
-#             print(f"Launching {browser_name} (fallback)")
-#             options = options_cls()
-#
-#             profile_path = get_default_profile(browser_name)
-#             if profile_path and os.path.exists(profile_path):
-#                 options.add_argument(f"user-data-dir={profile_path}")
-#                 print(f"Using profile: {profile_path}")
-#
-#             if browser_name in ("chrome", "brave"):
-#                 return webdriver.Chrome(service=service_cls(), options=options)
-#             elif browser_name == "firefox":
-#                 return webdriver.Firefox(service=service_cls(), options=options)
-#             elif browser_name == "edge":
-#                 return webdriver.Edge(service=service_cls(), options=options)
-#
-#     raise RuntimeError("No supported browser/driver found.")
-
-
-
-def get_driver():
-    profile_path = os.path.join(os.getcwd(), "chrome_profile")
-
-    chrome_options = Options()
-    chrome_options.add_argument(f"--user-data-dir={profile_path}")
-    chrome_options.add_argument("--profile-directory=Profile1")
-
-    return webdriver.Chrome(options=chrome_options)
-
-def ensureSignIn():
-    driver = get_driver()
-    url = "https://app.plex.tv/desktop/#!"
-    driver.get(url)
-
-    wait = WebDriverWait(driver, 15)
-
-    try:
-        # If we see the sign in button, user is NOT signed in
-        wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, '[data-testid="signInButton"]')))
-        print("Not signed in. Please log in manually in the opened browser...")
-
-        # Poll until the sign-in button disappears
-        WebDriverWait(driver, 300).until_not(
-            EC.presence_of_element_located((By.CSS_SELECTOR, '[data-testid="signInButton"]'))
-        )
-        print("Sign in detected, session ready")
-
-    except TimeoutException:
-        # If signInButton never appears, assume already signed in
-        print("No sign-in button detected, assuming already signed in")
-
-    return driver
-
-
-
-def setPlexWatchHistory(driver):
-    conn = db_conn()
-    c = conn.cursor()
-
-    # get all unrated films that are not in Plex history
-    c.execute("SELECT title, year FROM history WHERE in_plex_history=0")
-    films = c.fetchall()
-
-    wait = WebDriverWait(driver, 15)
-
-    for i, (title, year) in enumerate(films, start=1):
-        query = f"{title} {year}"
-        encoded_query = urllib.parse.quote(query)
-        url = f"https://app.plex.tv/desktop/#!/search?query={encoded_query}"
-        print(f"Searching Plex for: {title} ({year})")
-
-        driver.get(url)
-
-        try:
-            # wait for the search results to load
-            first_result = wait.until(
-                EC.presence_of_element_located(
-                    (By.CSS_SELECTOR, "div.SearchResultListRow-container-eOnSD1 a")
-                )
-            )
-
-            # click the first result link
-            first_result.click()
-            print(f"Clicked first result for {title} ({year})")
-
-            # locate "Mark Watched" and click if needed
-            try:
-                watch_button = WebDriverWait(driver, 10).until(
-                    EC.element_to_be_clickable(
-                        (By.CSS_SELECTOR, 'button[data-testid="preplay-togglePlayedState"]')
-                    )
-                )
-                watch_button.click()
-                print("Marked as Watched")
-
-                # update DB entry when successful
-                c.execute(
-                    "UPDATE history SET in_plex_history=1 WHERE title=? AND year=?",
-                    (title, year),
-                )
-                conn.commit()
-
-            except Exception as e:
-                print("Could not mark as watched:", e)
-
-        except Exception as e:
-            print(f"No results found for {title} ({year}): {e}")
-
-        # short wait between items
-        time.sleep(random.uniform(1, 3))
-
-        # longer wait every 5 items
-        if i % 5 == 0:
-            longer_wait = random.uniform(15, 30)  # random 15-30 seconds
-            print(f"Pausing for {longer_wait:.1f} seconds to avoid detection...")
-            time.sleep(longer_wait)
-
-    conn.commit()
-    conn.close()
-    
-def setPlexWatchRating(driver):
-    conn = db_conn()
-    c = conn.cursor()
-
-    c.execute("SELECT title, year, rating FROM history WHERE in_plex_rating=0 AND rated=1")
-    films = c.fetchall()
-
-    wait = WebDriverWait(driver, 15)
-
-    for title, year, rating in films:
-        query = f"{title} {year}"
-        encoded_query = urllib.parse.quote(query)
-        url = f"https://app.plex.tv/desktop/#!/search?query={encoded_query}"
-        print(f"Searching Plex for: {title} ({year})")
-
-        driver.get(url)
-
-        try:
-            first_result = wait.until(
-                EC.presence_of_element_located(
-                    (By.CSS_SELECTOR, "div.SearchResultListRow-container-eOnSD1 a")
-                )
-            )
-            first_result.click()
-            print(f"Clicked first result for {title} ({year})")
-
-            try:
-                # press the rate and review button
-                rate_button = wait.until(
-                    EC.element_to_be_clickable(
-                        (By.XPATH, "//button[.//span[text()='Rate & Review']]")
-                    )
-                )
-                rate_button.click()
-
-                # todo: select the stars level in the popup window
-                # todo: fix the issue where it doesnt move the slider
-                slider = wait.until(EC.presence_of_element_located((By.CLASS_NAME, "_1y79ovu5")))
-                rating_container = driver.find_element(By.CLASS_NAME, "_1h4p3k00")
-
-                # Optional: keep the stars element for logging
-                stars = rating_container.find_elements(By.CLASS_NAME, "rkbrtb0")
-                star_svg = stars[int(round(rating / 2)) - 1]
-
-                print(f"Intended rating: {rating}/10 (visual star index {int(round(rating / 2))})")
+@app.teardown_request
+def releaseDB(exc):
+    for attr, pool in (("db_ro", read_pool), ("db_rw", write_pool)):
+        conn = g.pop(attr, None)
+        if conn is not None:
+            pool.release(conn)
 
-                # Set slider value directly and trigger input/change events
-                driver.execute_script("""
-                    const s = arguments[0];
-                    const val = arguments[1];
-                    s.value = val;  // update the slider's internal value
-                    s.setAttribute('aria-valuenow', val);
-                    s.dispatchEvent(new Event('input', { bubbles: true }));
-                    s.dispatchEvent(new Event('change', { bubbles: true }));
-                """, slider, int(rating))
+@app.errorhandler(sqlite3.OperationalError)
+def databaseBusy(e):
+    """A lock held past the busy timeout is a retryable 503, anything else a real error."""
+    if "locked" not in str(e) and "busy" not in str(e):
+        raise e
+    return Response("Database is busy, try again shortly.\n", status=503,
+                    headers={"Retry-After": "2"}, mimetype="text/plain")
 
-                thumb = slider.find_element(By.XPATH, ".//span[contains(@style,'transform')]")
-                width = slider.size['width']
-                target_x = (rating / 10) * width - thumb.size['width'] / 2
-
-                actions = ActionChains(driver)
-                actions.click_and_hold(thumb).move_by_offset(target_x, 0).release().perform()
-
-                print("Rating set via slider.")
-
-                # todo: press save
-
-                pass # remove and readd update DB when above works as expected
-
-                # update DB entry
-                # c.execute(
-                #     "UPDATE history SET in_plex_rating=1 WHERE title=? AND year=?",
-                #     (title, year),
-                # )
-                # conn.commit()
-
-            except Exception as e:
-                print(" Could not set rating:", e)
-
-        except Exception as e:
-            print(f"No results found for {title} ({year}): {e}")
-        break
-
-    conn.commit()
-    conn.close()
-
-
-def setPlexWatchHistoryAndRating(driver):
-    conn = db_conn()
-    c = conn.cursor()
-
-    c.execute("SELECT title, year, rating FROM history WHERE in_plex_history=0 OR in_plex_rating=0")
-    films = c.fetchall()
-
-    wait = WebDriverWait(driver, 15)
-
-    for title, year, rating in films:
-        query = f"{title} {year}"
-        encoded_query = urllib.parse.quote(query)
-        url = f"https://app.plex.tv/desktop/#!/search?query={encoded_query}"
-        print(f"Searching Plex for: {title} ({year})")
-
-        driver.get(url)
-
-        try:
-            first_result = wait.until(
-                EC.presence_of_element_located(
-                    (By.CSS_SELECTOR, "div.SearchResultListRow-container-eOnSD1 a")
-                )
-            )
-            first_result.click()
-            print(f"Clicked first result for {title} ({year})")
-
-            # Handle history
-            try:
-                watch_button = WebDriverWait(driver, 10).until(
-                    EC.element_to_be_clickable((By.CSS_SELECTOR, 'button[data-testid="preplay-togglePlayedState"]'))
-                )
-                watch_button.click()
-                print(" Marked as Watched")
-                c.execute(
-                    "UPDATE history SET in_plex_history=1 WHERE title=? AND year=?",
-                    (title, year),
-                )
-                conn.commit()
-            except Exception as e:
-                print(" Could not mark as watched:", e)
-
-            # Handle rating
-            try:
-                print(" Rating set")
-                c.execute(
-                    "UPDATE history SET in_plex_rating=1 WHERE title=? AND year=?",
-                    (title, year),
-                )
-                conn.commit()
-            except Exception as e:
-                print(" Could not set rating:", e)
-
-        except Exception as e:
-            print(f"No results found for {title} ({year}): {e}")
-
-    conn.commit()
-    conn.close()
 
 # ---------- ROUTES ----------
 @app.route("/")
 def dashboard():
-    return render_template("dashboard.html")
+    full_import = trakt_sync.fullImportState(request_db().cursor())
+    return render_template("dashboard.html", job_id=request.args.get("job"), recent_jobs=runner.recent()[:5],
+                           full_import=full_import)
+
+
+def filmsCursor():
+    """Keyset cursor from ?before=<watched_at>&before_id=<history_id>, None for the first page."""
+    before = request.args.get("before")
+    before_id = request.args.get("before_id", type=int)
+    if before is None or before_id is None:
+        return None
+    return before, before_id
 
 
 @app.route("/films")
 def filmsInDB():
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute("SELECT slug, title, rating, watched_at, year FROM history ORDER BY watched_at DESC")
-    films = c.fetchall()
-    conn.close()
-    return render_template("films.html", films=films)
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 500)
+    c = request_db().cursor()
+    films = db.films_page(c, limit, filmsCursor())
+
+    next_page = None
+    if len(films) == limit:
+        last = films[-1]
+        next_page = url_for("filmsInDB", limit=limit, before=last[3], before_id=last[5])
+    return render_template("films.html", films=films, limit=limit,
+                           next_page=next_page, first_page=filmsCursor() is None)
+
+
+@app.route("/api/films")
+def filmsJSON():
+    """Same rows as /films streamed as a JSON array, in batches so memory stays flat."""
+    limit = request.args.get("limit", type=int)
+    cursor = filmsCursor()
+    batch_size = 500
+    keys = ("slug", "title", "rating", "watched_at", "year", "history_id")
+
+    def generate():
+        c = request_db().cursor()
+        before, sent = cursor, 0
+        yield "["
+        while limit is None or sent < limit:
+            size = batch_size if limit is None else min(batch_size, limit - sent)
+            rows = db.films_page(c, size, before)
+            for row in rows:
+                yield ("," if sent else "") + json.dumps(dict(zip(keys, row)))
+                sent += 1
+            if len(rows) < size:
+                break
+            before = (rows[-1][3], rows[-1][5])
+        yield "]"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
 
 
 @app.route("/rate", methods=["GET", "POST"])
 def rate():
-    conn = db_conn()
-    c = conn.cursor()
-
     if request.method == "POST":
-        ratings_to_submit = []
-        for slug, rating in request.form.items():
-            if rating.strip():  # only if user filled
-                ratings_to_submit.append((slug, int(rating)))
-
-        if ratings_to_submit:
-            rated_at = datetime.datetime.utcnow().isoformat() + "Z"
-            payload = {"movies": []}
-            for slug, rating in ratings_to_submit:
-                payload["movies"].append({
-                    "ids": {"slug": slug},
-                    "rating": rating,
-                    "rated_at": rated_at
-                })
-
-            # push to Trakt
-            r = requests.post("https://api.trakt.tv/sync/ratings",
-                              headers=trakt_headers(CLIENT_ID, TOKEN["access_token"]), json=payload)
-            r.raise_for_status()
-
-            # update DB
-            for slug, rating in ratings_to_submit:
-                c.execute("UPDATE history SET rated=1, rating=? WHERE slug=?", (rating, slug))
-                c.execute("DELETE FROM unrated WHERE slug=?", (slug,))
-            conn.commit()
-
-        conn.close()
+        rated_at = datetime.datetime.utcnow().isoformat() + "Z"
+        items = [{"ids": {"slug": slug}, "rating": int(rating), "rated_at": rated_at}
+                 for slug, rating in request.form.items()
+                 if rating.strip()]  # only if user filled
+
+        if items:
+            # push to Trakt, the films it accepted leave the unrated queue
+            trakt_sync.submitRatings(trakt_sync.trakt_client(), items, conn=request_db(readonly=False))
+
         return redirect(url_for("rate"))
 
     # GET mode: fetch unrated films
@@ -628,12 +124,11 @@ def rate():
     limit = int(request.args.get("limit", 10))  # allow ?limit=20 etc
     offset = (page - 1) * limit
 
+    c = request_db().cursor()
     c.execute("SELECT slug, title FROM unrated ORDER BY rowid DESC LIMIT ? OFFSET ?", (limit, offset))
     films = c.fetchall()
 
-    c.execute("SELECT COUNT(*) FROM unrated")
-    total = c.fetchone()[0]
-    conn.close()
+    total = db.unrated_count(c)
 
     total_pages = (total + limit - 1) // limit
 
@@ -647,31 +142,67 @@ def rate():
     )
 
 
+@app.route("/rate/import", methods=["POST"])
+def importRatings():
+    """Rate everything in an uploaded IMDb or Letterboxd export, as a background job."""
+    upload = request.files.get("file")
+    if upload is None:
+        abort(400, "no file uploaded")
+    try:
+        items = trakt_sync.readRatingsCSV(io.TextIOWrapper(upload.stream, encoding="utf-8-sig"))
+    except (ValueError, KeyError, csv.Error) as e:
+        abort(400, str(e))
+    job = runner.submit("rate", "import", "import ratings", trakt_sync.submitRatings,
+                        trakt_sync.trakt_client(), items)
+    return redirect(url_for("dashboard", job=job.id))
 
-# ---------- STUBS FOR SYNC TASKS ----------
+
+# ---------- SYNC / PUSH JOBS ----------
 @app.route("/sync/<mode>")
 def sync(mode):
-    headers = trakt_headers(CLIENT_ID, TOKEN["access_token"])
-    if mode == "recent":
-        getHistory(headers)
-    elif mode == "full":
-        getAllHistory(headers)
-    elif mode == "ratings":
-        getHistoryRating(headers)
-    return redirect(url_for("dashboard"))
+    if mode not in trakt_sync.SYNC_ACTIVITIES:
+        abort(404)
+    job = runner.submit("sync", mode, f"sync {mode}", trakt_sync.runSync, mode, trakt_sync.trakt_client(),
+                        force=request.args.get("force") == "1",
+                        restart=request.args.get("restart") == "1")
+    return redirect(url_for("dashboard", job=job.id))
+
+@app.route("/sync/full/status")
+def fullSyncStatus():
+    return jsonify(trakt_sync.fullImportState(request_db().cursor()))
 
 @app.route("/push/<mode>")
 def push(mode):
-    driver = ensureSignIn()
-    if mode == "history":
-        setPlexWatchHistory(driver)
-    elif mode == "ratings":
-        # setPlexWatchRating(driver)
-        pass
-    elif mode == "all":
-        # setPlexWatchHistoryAndRating(driver)
-        pass
-    return redirect(url_for("dashboard"))
+    if mode not in plex_push.PUSH_MODES:
+        abort(404)
+    job = runner.submit("push", mode, f"push {mode}", plex_push.runPush, mode)
+    return redirect(url_for("dashboard", job=job.id))
+
+@app.route("/reconcile")
+def reconcileStates():
+    """Two-way Trakt/Plex reconcile as a job; ?dry_run=1 only reports the differences."""
+    dry_run = request.args.get("dry_run") == "1"
+    mode, name = ("reconcile-dry-run", "reconcile (dry run)") if dry_run else ("reconcile", "reconcile")
+    job = runner.submit("push", mode, name, reconcile.runReconcile, trakt_sync.trakt_client(), dry_run=dry_run)
+    return redirect(url_for("dashboard", job=job.id))
+
+@app.route("/metrics")
+def metricsPage():
+    """Prometheus scrape endpoint."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/jobs")
+def jobList():
+    return jsonify([job.to_dict() for job in runner.recent()])
+
+@app.route("/jobs/<job_id>")
+def jobStatus(job_id):
+    job = runner.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict())
 
 if __name__ == "__main__":
+    db.migrate()
     app.run(debug=True)
\ No newline at end of file
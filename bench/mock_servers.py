@@ -0,0 +1,259 @@
+"""Local stand-ins for the Trakt and Plex endpoints the sync and push paths use.
+
+Both generate their data from a size on the fly, so a 100k play history
+costs no memory up front. Every request can be slowed down (`latency`) or
+answered with a 429 (`fail_rate`) to exercise the client's retry path.
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# every film is watched this many times on average
+REWATCH = 3
+
+
+def movie(n):
+    return {"title": f"Movie {n}", "year": 1950 + n % 70,
+            "ids": {"trakt": n, "slug": f"movie-{n}", "imdb": f"tt{n:07d}", "tmdb": n}}
+
+
+def episode(n):
+    """Shows have 5 seasons of 20 episodes."""
+    show = n // 100
+    return ({"title": f"Show {show}", "year": 1990 + show % 30,
+             "ids": {"trakt": show + 1, "slug": f"show-{show}", "tvdb": 70000 + show, "imdb": f"tt9{show:06d}"}},
+            {"season": n % 100 // 20 + 1, "number": n % 20 + 1, "title": f"Episode {n}",
+             "ids": {"trakt": n + 1, "tvdb": 900000 + n}})
+
+
+def watched_at(play):
+    """Newer plays have higher ids and later timestamps."""
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(1_000_000_000 + play * 600))
+
+
+class MockServer:
+    """Threaded HTTP server around a handler class, counts every request."""
+
+    def __init__(self, handler, latency=0.0, fail_rate=0.0):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.requests = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        handler_cls = type(handler.__name__, (handler,), {"mock": self})
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler_cls)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self):
+        """(requests, throttled) so far, and resets both."""
+        with self._lock:
+            counts = self.requests, self.throttled
+            self.requests = self.throttled = 0
+        return counts
+
+    def admit(self):
+        """Account for a request, sleep the latency; False when it should get a 429."""
+        throttled = random.random() < self.fail_rate
+        with self._lock:
+            self.requests += 1
+            self.throttled += throttled
+        if self.latency:
+            time.sleep(self.latency)
+        return not throttled
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock = None
+
+    def log_message(self, *args):
+        pass
+
+    def _query(self):
+        parsed = urllib.parse.urlparse(self.path)
+        return parsed.path, dict(urllib.parse.parse_qsl(parsed.query))
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, obj, headers=None):
+        body = json.dumps(obj).encode()
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            return self._send(304, headers={"ETag": etag})
+        self._send(200, body, dict(headers or {}, ETag=etag, **{"Content-Type": "application/json"}))
+
+
+class TraktHandler(_Handler):
+    """/sync/history/movies and /sync/history/episodes (paged, newest first),
+    /sync/watched/movies, /sync/ratings/movies, /sync/last_activities and the
+    /sync/ratings and /sync/history POSTs."""
+
+    def do_GET(self):
+        if not self.mock.admit():
+            return self._send(429, headers={"Retry-After": "0.01"})
+        path, q = self._query()
+        size = self.mock.size
+        if path in ("/sync/history/movies", "/sync/history/episodes"):
+            limit = int(q.get("limit", 10))
+            page = int(q.get("page", 1))
+            plays = size
+            if q.get("start_at"):
+                plays = sum(1 for p in range(size) if watched_at(p) >= q["start_at"])
+            newest = size - 1 - (page - 1) * limit
+            items = [self._play(path, p) for p in range(newest, max(newest - limit, size - 1 - plays), -1)]
+            return self._json(items, {"X-Pagination-Page": page,
+                                      "X-Pagination-Page-Count": max(1, -(-plays // limit)),
+                                      "X-Pagination-Item-Count": plays})
+        if path == "/sync/watched/movies":
+            items = [{"plays": REWATCH, "last_watched_at": watched_at(n), "movie": movie(n)}
+                     for n in range(min(size, self.mock.movies))]
+            return self._json(items)
+        if path == "/sync/ratings/movies":
+            # two films in three are rated
+            items = [{"rating": 1 + n % 10, "rated_at": watched_at(n), "type": "movie", "movie": movie(n)}
+                     for n in range(self.mock.movies) if n % 3]
+            return self._json(items, {"X-Pagination-Item-Count": len(items)})
+        if path == "/sync/last_activities":
+            return self._json({"movies": {"watched_at": watched_at(size), "rated_at": watched_at(size)},
+                               "episodes": {"watched_at": watched_at(size)}})
+        self._send(404)
+
+    def _play(self, path, p):
+        if path.endswith("/movies"):
+            return {"id": p + 1, "watched_at": watched_at(p), "action": "watch", "type": "movie",
+                    "movie": movie(p % self.mock.movies)}
+        show, ep = episode(p % self.mock.episodes)
+        return {"id": p + 1, "watched_at": watched_at(p), "action": "watch", "type": "episode",
+                "show": show, "episode": ep}
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if not self.mock.admit():
+            return self._send(429, headers={"Retry-After": "0.01"})
+        body = json.dumps({"added": {"movies": len(payload.get("movies", []))},
+                           "not_found": {"movies": []}}).encode()
+        self._send(201, body, {"Content-Type": "application/json"})
+
+
+class PlexHandler(_Handler):
+    """One movie section holding most of the mock Trakt films and some films
+    Trakt doesn't know, a few already watched or rated in Plex; one show
+    section holding every mock Trakt episode plus unnumbered specials; and
+    scrobble/rate."""
+
+    def do_GET(self):
+        if not self.mock.admit():
+            return self._send(429)
+        path, q = self._query()
+        if path == "/library/sections":
+            return self._json({"MediaContainer": {"Directory": [{"key": "1", "type": "movie", "title": "Movies"},
+                                                                 {"key": "2", "type": "show", "title": "TV Shows"}]}})
+        if path == "/library/sections/1/all":
+            return self._section(q)
+        if path == "/library/sections/2/all":
+            return self._shows(q) if q.get("type") == "2" else self._episodes(q)
+        if path == "/:/scrobble":
+            return self._send(200)
+        self._send(404)
+
+    def do_PUT(self):
+        if not self.mock.admit():
+            return self._send(429)
+        self._send(200 if self._query()[0] == "/:/rate" else 404)
+
+    def _section(self, q):
+        # every tenth film is missing from the library, one in twenty more were only watched in Plex
+        keys = [n for n in range(self.mock.movies) if n % 10]
+        keys += range(self.mock.movies, self.mock.movies + self.mock.movies // 20)
+        if "title" in q:
+            keys = [n for n in keys if movie(n)["title"] == q["title"]]
+        if "updatedAt>>" in q:
+            keys = [n for n in keys if 1_000_000 + n > int(q["updatedAt>>"])]
+        start = int(q.get("X-Plex-Container-Start", 0))
+        size = int(q.get("X-Plex-Container-Size", len(keys)))
+        items = []
+        for n in keys[start:start + size]:
+            m = movie(n)
+            item = {"ratingKey": str(100000 + n), "title": m["title"], "year": m["year"],
+                    "updatedAt": 1_000_000 + n,
+                    "Guid": [{"id": f"imdb://{m['ids']['imdb']}"}, {"id": f"tmdb://{n}"}]}
+            plex_only = n >= self.mock.movies
+            if plex_only or n % 4 == 0:
+                item.update(viewCount=1, lastViewedAt=1_000_000_000 + n * 600)
+            if plex_only or n % 6 == 0:
+                item["userRating"] = float(1 + n % 10)
+            items.append(item)
+        self._json({"MediaContainer": {"size": len(items), "totalSize": len(keys), "Metadata": items}})
+
+
+    def _page(self, q, total, item):
+        start = int(q.get("X-Plex-Container-Start", 0))
+        size = int(q.get("X-Plex-Container-Size", total))
+        items = [item(i) for i in range(start, min(start + size, total))]
+        self._json({"MediaContainer": {"size": len(items), "totalSize": total, "Metadata": items}})
+
+    def _shows(self, q):
+        def show(i):
+            m = episode(i * 100)[0]
+            return {"ratingKey": str(1_000_000 + i), "title": m["title"], "year": m["year"],
+                    "Guid": [{"id": f"tvdb://{m['ids']['tvdb']}"}, {"id": f"imdb://{m['ids']['imdb']}"}]}
+        self._page(q, -(-self.mock.episodes // 100), show)
+
+    def _episodes(self, q):
+        # every fifth show has an unwatched special without numbering in its first season,
+        # every third one episode Plex already shows watched; the specials come last
+        numbered = self.mock.episodes
+        shows = -(-numbered // 100)
+
+        def item(i):
+            if i >= numbered:
+                show = (i - numbered) * 5
+                return {"ratingKey": str(4_000_000 + show), "title": "Special",
+                        "grandparentRatingKey": str(1_000_000 + show), "parentRatingKey": str(2_000_000 + show * 10 + 1)}
+            show, ep = episode(i)
+            return {"ratingKey": str(3_000_000 + i), "title": ep["title"],
+                    "grandparentRatingKey": str(1_000_000 + i // 100),
+                    "parentRatingKey": str(2_000_000 + i // 100 * 10 + ep["season"]),
+                    "parentIndex": ep["season"], "index": ep["number"],
+                    "viewCount": int(i % 300 == 0)}
+        self._page(q, numbered + -(-shows // 5), item)
+
+
+def trakt_server(size, latency=0.0, fail_rate=0.0):
+    server = MockServer(TraktHandler, latency, fail_rate)
+    server.size = size
+    server.movies = max(1, size // REWATCH)
+    # episodes are mostly watched once
+    server.episodes = max(1, size * 9 // 10)
+    return server
+
+
+def plex_server(movies, episodes, latency=0.0, fail_rate=0.0):
+    server = MockServer(PlexHandler, latency, fail_rate)
+    server.movies = movies
+    server.episodes = episodes
+    return server
@@ -0,0 +1,244 @@
+"""Offline benchmark of the sync, browse, push and reconcile paths.
+
+    python bench/run.py                      # 1k, 10k and 100k plays
+    python bench/run.py --sizes 10000 --latency 0.02 --fail-rate 0.01
+
+The same sizes are used for episode plays. Each size runs in its own process, in a scratch directory with a fresh
+database, against the mock servers in bench/mock_servers.py. Reported per
+phase: wall time, requests served by the mocks (and the 429s among them),
+requests per second, time spent inside db.py and the process's peak RSS so
+far. Trakt's own rate limit is lifted so the numbers measure this code, not
+the 1000-per-5-minutes budget.
+"""
+import argparse
+import functools
+import html
+import inspect
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+PHASES = ("full sync", "ratings sync", "episode sync", "/films", "/api/films", "/rate", "plex push",
+          "episode push", "reconcile dry run", "reconcile")
+
+
+class DBTimer:
+    """Wraps every helper in db.py that takes a cursor and adds up the time spent in them."""
+
+    def __init__(self, db):
+        self.total = 0.0
+        self._lock = threading.Lock()
+        for name, fn in inspect.getmembers(db, inspect.isfunction):
+            params = list(inspect.signature(fn).parameters)
+            if fn.__module__ == db.__name__ and params[:1] == ["c"]:
+                setattr(db, name, self.wrap(fn))
+
+    def wrap(self, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.total += time.perf_counter() - start
+        return timed
+
+    def take(self):
+        with self._lock:
+            total, self.total = self.total, 0.0
+        return total
+
+
+def peak_rss_mb():
+    # ru_maxrss is KB on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def run_size(size, latency, fail_rate, workers):
+    """Benchmark one dataset size in the current process, returns the phase results."""
+    import mock_servers
+
+    trakt_mock = mock_servers.trakt_server(size, latency, fail_rate).start()
+    plex_mock = mock_servers.plex_server(trakt_mock.movies, trakt_mock.episodes, latency).start()
+
+    # config.py reads API_KEYS.json from the working directory
+    work = tempfile.mkdtemp(prefix="trakt-bench-")
+    os.chdir(work)
+    with open("API_KEYS.json", "w") as f:
+        json.dump({"Trakt_Client_ID": "bench", "Trakt_Client_Secret": "bench",
+                   "Plex_URL": plex_mock.url, "Plex_Token": "bench"}, f)
+    with open("trakt_token.json", "w") as f:
+        json.dump({"access_token": "bench"}, f)
+
+    import config
+    import db
+    import Main
+    import metrics
+    import push
+    import reconcile
+    import sync
+    from http_cache import ResponseCache
+    from plex import PlexClient
+    from trakt import TraktClient, TokenBucket
+
+    db_timer = DBTimer(db)
+    db.migrate()
+    trakt = TraktClient("bench", "bench", base_url=trakt_mock.url, pool_size=workers * 2,
+                        backoff=0.01, cache=ResponseCache(os.path.join(work, "trakt_cache.db")))
+    trakt.get_bucket = TokenBucket(1e9, capacity=1e9)
+    trakt.write_bucket = TokenBucket(1e9, capacity=1e9)
+    plex = PlexClient(plex_mock.url, "bench", pool_size=config.PLEX_WORKERS)
+    client = Main.app.test_client()
+
+    def films_pages():
+        # first page, then follow the "Older" link ten pages deep
+        url = "/films?limit=50"
+        for _ in range(10):
+            r = client.get(url)
+            assert r.status_code == 200, r.status_code
+            older = re.search(r'href="([^"]*before_id=[^"]*)">Older', r.get_data(as_text=True))
+            if not older:
+                break
+            url = html.unescape(older.group(1))
+
+    def api_films():
+        r = client.get("/api/films")
+        return sum(len(chunk) for chunk in r.response)
+
+    def rate_pages():
+        for page in range(1, 11):
+            assert client.get(f"/rate?page={page}&limit=50").status_code == 200
+
+    def plex_push():
+        push.refreshPlexLibrary(plex)
+        push.setPlexWatchHistoryAPI(plex)
+        push.setPlexWatchRatingAPI(plex)
+
+    reconciled = {}
+
+    def reconcile_dry_run():
+        reconciled["plan"] = reconcile.reconcile(plex, trakt, dry_run=True)
+
+    def reconcile_apply():
+        reconciled["sent"] = reconcile.reconcile(plex, trakt)["sent"]
+
+    steps = {
+        "full sync": lambda: sync.getAllHistory(trakt, workers=workers),
+        "ratings sync": lambda: sync.getHistoryRating(trakt),
+        "episode sync": lambda: sync.getAllHistory(trakt, workers=workers, kind="episodes"),
+        "/films": films_pages,
+        "/api/films": api_films,
+        "/rate": rate_pages,
+        "plex push": plex_push,
+        "episode push": lambda: push.pushEpisodesToPlex(plex),
+        "reconcile dry run": reconcile_dry_run,
+        "reconcile": reconcile_apply,
+    }
+
+    results = []
+    for phase in PHASES:
+        trakt_mock.count(), plex_mock.count(), db_timer.take()
+        start = time.perf_counter()
+        steps[phase]()
+        wall = time.perf_counter() - start
+        trakt_requests, throttled = trakt_mock.count()
+        plex_requests, _ = plex_mock.count()
+        requests_made = trakt_requests + plex_requests
+        results.append({
+            "size": size,
+            "phase": phase,
+            "wall_s": round(wall, 3),
+            "requests": requests_made,
+            "throttled": throttled,
+            "req_per_s": round(requests_made / wall, 1) if wall > 0 else 0.0,
+            "db_s": round(db_timer.take(), 3),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+        })
+
+    # /metrics must keep rendering once a connection error sits next to numeric statuses
+    metrics.inc("trakt_responses_total", status="error")
+    r = client.get("/metrics")
+    if r.status_code != 200 or 'status="error"' not in r.get_data(as_text=True):
+        raise RuntimeError(f"/metrics failed with mixed status labels ({r.status_code})")
+
+    # the mocks keep no state, so the apply run sends exactly what the dry run planned
+    planned = {name: reconciled["plan"][name]["count"] for name in reconciled["sent"]}
+    if planned != reconciled["sent"] or not planned["trakt_history"]:
+        raise RuntimeError(f"reconcile planned {planned} but sent {reconciled['sent']}")
+
+    c = db.get_conn().cursor()
+    c.execute("""SELECT (SELECT COUNT(*) FROM watches), (SELECT COUNT(*) FROM movies WHERE in_plex_history=1),
+                        (SELECT COUNT(*) FROM episode_watches), (SELECT COUNT(*) FROM episodes WHERE in_plex_history=0)""")
+    plays, pushed, episode_plays, episodes_left = c.fetchone()
+    if plays != size or episode_plays != size:
+        raise RuntimeError(f"expected {size} movie and episode plays in the database, "
+                           f"found {plays} and {episode_plays}")
+    if episodes_left:
+        raise RuntimeError(f"{episodes_left} episodes weren't pushed to the mock Plex")
+    c.execute("""SELECT SUM(pgsize) FROM dbstat
+                 WHERE name IN ('shows', 'episodes', 'episode_watches') OR name LIKE 'idx_episodes%'""")
+    episode_mb = (c.fetchone()[0] or 0) / 1024 / 1024
+    print(f"{size} plays: {pushed} films pushed to the mock Plex, "
+          f"episode store {episode_mb:.1f} MB", file=sys.stderr)
+
+    trakt_mock.stop()
+    plex_mock.stop()
+    return results
+
+
+def print_table(results):
+    columns = ("size", "phase", "wall_s", "requests", "throttled", "req_per_s", "db_s", "peak_rss_mb")
+    widths = [max(len(col), *(len(str(r[col])) for r in results)) for col in columns]
+    print("  ".join(col.ljust(w) for col, w in zip(columns, widths)))
+    for r in results:
+        print("  ".join(str(r[col]).ljust(w) for col, w in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="history plays per run (films are a third of that)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every mock response")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of Trakt requests answered with 429")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent Trakt page fetches")
+    parser.add_argument("--json", action="store_true", help="print results as JSON instead of a table")
+    parser.add_argument("--one", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one:
+        # child process: one size, results as JSON on stdout
+        json.dump(run_size(args.one, args.latency, args.fail_rate, args.workers), sys.stdout)
+        return
+
+    results = []
+    for size in args.sizes:
+        # a fresh process per size keeps the database, imports and peak RSS separate
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--one", str(size),
+             "--latency", str(args.latency), "--fail-rate", str(args.fail_rate),
+             "--workers", str(args.workers)],
+            stdout=subprocess.PIPE, check=True, text=True,
+        ).stdout
+        results.extend(json.loads(out.strip().splitlines()[-1]))
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,577 @@
+import atexit
+import os
+import random
+import shutil
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+
+from selenium import webdriver
+from selenium.common import TimeoutException, WebDriverException
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.common.action_chains import ActionChains
+
+import config
+import db
+import jobs
+import metrics
+from pipeline import DBWriter
+from push import isKnownMiss
+
+PLEX_WEB = "https://app.plex.tv/desktop/#!"
+SIGN_IN_BUTTON = (By.CSS_SELECTOR, '[data-testid="signInButton"]')
+
+# Chrome's per-instance lock files, never copied into a cloned profile
+PROFILE_LOCKS = shutil.ignore_patterns("Singleton*", "lockfile")
+
+
+def new_driver(profile_path, headless=False):
+    """Chrome on the persistent profile, so the Plex login survives restarts."""
+    chrome_options = Options()
+    chrome_options.add_argument(f"--user-data-dir={profile_path}")
+    chrome_options.add_argument("--profile-directory=Profile1")
+    if headless:
+        chrome_options.add_argument("--headless=new")
+        chrome_options.add_argument("--window-size=1280,900")
+    return webdriver.Chrome(options=chrome_options)
+
+
+def alive(driver):
+    """Whether the browser still answers, a crashed or closed one raises here."""
+    try:
+        driver.execute_script("return 1")
+        return bool(driver.window_handles)
+    except WebDriverException:
+        return False
+
+
+def ensure_signed_in(driver, headless=False):
+    """Open Plex web and wait for a manual login if the profile isn't signed in."""
+    driver.get(PLEX_WEB)
+    try:
+        # If we see the sign in button, user is NOT signed in
+        with metrics.span("webdriver.wait"):
+            WebDriverWait(driver, 15).until(EC.presence_of_element_located(SIGN_IN_BUTTON))
+    except TimeoutException:
+        # If signInButton never appears, assume already signed in
+        print("No sign-in button detected, assuming already signed in")
+        return
+
+    if headless:
+        raise RuntimeError("Plex is not signed in; run one push with Plex_Headless off and log in")
+    print("Not signed in. Please log in manually in the opened browser...")
+    # Poll until the sign-in button disappears
+    WebDriverWait(driver, 300).until_not(EC.presence_of_element_located(SIGN_IN_BUTTON))
+    print("Sign in detected, session ready")
+
+
+class DriverManager:
+    """Keeps one signed-in browser warm between pushes.
+
+    session() hands out the browser to one caller at a time. It is started
+    and signed in on first use, health-checked before every later use, and
+    quit when a push fails with the browser in a bad state so the next push
+    gets a fresh one. The browser is shut down when the process exits.
+    """
+
+    def __init__(self, profile_path, headless=False, template=None):
+        self.profile_path = profile_path
+        self.headless = headless
+        # profile to copy from when profile_path doesn't exist yet
+        self.template = template
+        self.driver = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _ensure(self):
+        if self.driver is not None and not alive(self.driver):
+            print("Browser session lost, starting a new one")
+            self._quit()
+        if self.driver is None:
+            self._start()
+
+    def warm(self):
+        """Start (or restart) the browser now so the next session() is instant."""
+        with self._lock:
+            self._ensure()
+
+    @contextmanager
+    def session(self):
+        with self._lock:
+            self._ensure()
+            try:
+                yield self.driver
+            except Exception:
+                if not alive(self.driver):
+                    self._quit()
+                raise
+
+    def _start(self):
+        if self.template and not os.path.isdir(self.profile_path):
+            # a copy of the signed-in profile carries the Plex login over
+            shutil.copytree(self.template, self.profile_path, ignore=PROFILE_LOCKS)
+        with metrics.span("webdriver.start"):
+            driver = new_driver(self.profile_path, self.headless)
+        try:
+            ensure_signed_in(driver, self.headless)
+        except Exception:
+            driver.quit()
+            raise
+        self.driver = driver
+
+    def _quit(self):
+        driver, self.driver = self.driver, None
+        if driver is None:
+            return
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass  # already gone
+
+    def close(self):
+        with self._lock:
+            self._quit()
+
+
+class BrowserPool:
+    """Several warm browsers for pushing in parallel.
+
+    The first uses the real profile; the others each run on their own copy
+    of it (Chrome won't share a profile directory between instances), made
+    the first time that browser starts.
+    """
+
+    def __init__(self, profile_path, size=1, headless=False):
+        self.managers = [DriverManager(profile_path, headless)]
+        for i in range(1, max(1, size)):
+            self.managers.append(DriverManager(f"{profile_path}_{i}", headless, template=profile_path))
+
+    @contextmanager
+    def sessions(self, count=None):
+        """Up to `count` signed-in drivers. The first has to start; the rest
+        start in parallel and any that fail to are left out."""
+        managers = self.managers[:count or len(self.managers)]
+        with ExitStack() as stack:
+            # sign in on the real profile first so the copies are signed in too
+            drivers = [stack.enter_context(managers[0].session())]
+            if len(managers) > 1:
+                with ThreadPoolExecutor(max_workers=len(managers) - 1) as pool:
+                    started = [(m, pool.submit(metrics.bind(m.warm))) for m in managers[1:]]
+                for manager, future in started:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"Could not start browser on {manager.profile_path}: {e}")
+                        continue
+                    drivers.append(stack.enter_context(manager.session()))
+            yield drivers
+
+    def close(self):
+        for manager in self.managers:
+            manager.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool():
+    """The warm browsers shared by every Selenium push, created on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BrowserPool(os.path.join(os.getcwd(), "chrome_profile"),
+                                size=config.PLEX_BROWSER_WORKERS, headless=config.PLEX_HEADLESS)
+        return _pool
+
+
+# ---------- SELENIUM PUSH ----------
+def browserMarkWatched(driver, film, match):
+    """Find one film on app.plex.tv and mark it watched.
+
+    Returns (lookup, marked): a plex_match row to record (None when the
+    film's page was already known) and whether it was marked watched.
+    """
+    slug, title, year = film
+    lookup = None
+    try:
+        if match and match[2]:
+            # found before, go straight to its details page
+            with metrics.span("webdriver.navigate"):
+                driver.get(match[2])
+            print(f"Opened known Plex page for {title} ({year})")
+        else:
+            query = f"{title} {year}"
+            encoded_query = urllib.parse.quote(query)
+            url = f"https://app.plex.tv/desktop/#!/search?query={encoded_query}"
+            print(f"Searching Plex for: {title} ({year})")
+
+            with metrics.span("webdriver.navigate"):
+                driver.get(url)
+
+            # wait for the search results to load
+            with metrics.span("webdriver.wait"):
+                first_result = WebDriverWait(driver, 15).until(
+                    EC.presence_of_element_located(
+                        (By.CSS_SELECTOR, "div.SearchResultListRow-container-eOnSD1 a")
+                    )
+                )
+            plex_url = first_result.get_attribute("href")
+
+            # click the first result link
+            with metrics.span("webdriver.click"):
+                first_result.click()
+            print(f"Clicked first result for {title} ({year})")
+            lookup = (slug, 1, None, plex_url, int(time.time()))
+
+    except Exception as e:
+        if not alive(driver):
+            raise  # the browser died, not a miss
+        print(f"No results found for {title} ({year}): {e}")
+        return (slug, 0, None, None, int(time.time())), False
+
+    # locate "Mark Watched" and click if needed
+    try:
+        with metrics.span("webdriver.wait"):
+            watch_button = WebDriverWait(driver, 10).until(
+                EC.element_to_be_clickable(
+                    (By.CSS_SELECTOR, 'button[data-testid="preplay-togglePlayedState"]')
+                )
+            )
+        # the button toggles: on a film Plex already shows watched it reads
+        # "Mark as Unplayed", and clicking it would undo the play
+        label = " ".join(filter(None, (watch_button.get_attribute("aria-label"),
+                                       watch_button.get_attribute("title"), watch_button.text))).lower()
+        if "unplayed" in label or "unwatched" in label:
+            print("Already watched in Plex")
+            return lookup, True
+        with metrics.span("webdriver.click"):
+            watch_button.click()
+        print("Marked as Watched")
+        return lookup, True
+
+    except Exception as e:
+        if not alive(driver):
+            raise
+        print("Could not mark as watched:", e)
+        return lookup, False
+
+
+def setInPlexHistory(c, slug):
+    c.execute("UPDATE movies SET in_plex_history=1 WHERE slug=?", (slug,))
+
+
+def browserPushShard(driver, films, matches, writer, job):
+    """Push one browser's share of the films, with that browser's own pacing."""
+    for i, film in enumerate(films, start=1):
+        lookup, marked = browserMarkWatched(driver, film, matches[film[0]])
+        if lookup is not None:
+            writer.put(db.record_plex_matches, [lookup], commit=not marked)
+        if marked:
+            # update DB entry when successful
+            writer.put(setInPlexHistory, film[0], commit=True)
+        if job is not None:
+            job.progress(advance=1)
+
+        # short wait between items
+        metrics.sleep(random.uniform(1, 3))
+
+        # longer wait every 5 items
+        if i % 5 == 0:
+            longer_wait = random.uniform(15, 30)  # random 15-30 seconds
+            print(f"Pausing for {longer_wait:.1f} seconds to avoid detection...")
+            metrics.sleep(longer_wait)
+
+
+def setPlexWatchHistory(drivers):
+    """Mark films watched through app.plex.tv, split across the given browsers.
+
+    Each browser works through its own share of the films with its own
+    pauses; all of them hand their DB updates to one writer.
+    """
+    c = db.get_conn().cursor()
+
+    # get all films that are not in Plex history, once per film however often it was watched
+    c.execute("SELECT slug, title, year FROM movies WHERE in_plex_history=0")
+    films = c.fetchall()
+
+    # films that weren't found last time aren't searched again until the miss expires
+    now = int(time.time())
+    matches = {slug: db.get_plex_match(c, slug) for slug, _, _ in films}
+    films = [film for film in films if not isKnownMiss(matches[film[0]], now)]
+
+    # browser threads aren't the job thread, so report through the job itself
+    job = jobs.current()
+    jobs.progress(done=0, total=len(films), message="films")
+    shards = [films[i::len(drivers)] for i in range(len(drivers))]
+    if len(drivers) > 1:
+        print(f"Pushing {len(films)} films with {len(drivers)} browsers")
+
+    with DBWriter() as writer, ThreadPoolExecutor(max_workers=len(drivers)) as pool:
+        futures = [pool.submit(metrics.bind(browserPushShard), driver, shard, matches, writer, job)
+                   for driver, shard in zip(drivers, shards)]
+        # wait for every browser, then report the first failure
+        for future in futures:
+            future.exception()
+        for future in futures:
+            future.result()
+
+
+def setPlexWatchRating(driver):
+    conn = db.get_conn()
+    c = conn.cursor()
+
+    c.execute("SELECT title, year, rating FROM movies WHERE in_plex_rating=0 AND rated=1")
+    films = c.fetchall()
+
+    wait = WebDriverWait(driver, 15)
+
+    for title, year, rating in films:
+        query = f"{title} {year}"
+        encoded_query = urllib.parse.quote(query)
+        url = f"https://app.plex.tv/desktop/#!/search?query={encoded_query}"
+        print(f"Searching Plex for: {title} ({year})")
+
+        driver.get(url)
+
+        try:
+            first_result = wait.until(
+                EC.presence_of_element_located(
+                    (By.CSS_SELECTOR, "div.SearchResultListRow-container-eOnSD1 a")
+                )
+            )
+            first_result.click()
+            print(f"Clicked first result for {title} ({year})")
+
+            try:
+                # press the rate and review button
+                rate_button = wait.until(
+                    EC.element_to_be_clickable(
+                        (By.XPATH, "//button[.//span[text()='Rate & Review']]")
+                    )
+                )
+                rate_button.click()
+
+                # todo: select the stars level in the popup window
+                # todo: fix the issue where it doesnt move the slider
+                slider = wait.until(EC.presence_of_element_located((By.CLASS_NAME, "_1y79ovu5")))
+                rating_container = driver.find_element(By.CLASS_NAME, "_1h4p3k00")
+
+                # Optional: keep the stars element for logging
+                stars = rating_container.find_elements(By.CLASS_NAME, "rkbrtb0")
+                star_svg = stars[int(round(rating / 2)) - 1]
+
+                print(f"Intended rating: {rating}/10 (visual star index {int(round(rating / 2))})")
+
+                # Set slider value directly and trigger input/change events
+                driver.execute_script("""
+                    const s = arguments[0];
+                    const val = arguments[1];
+                    s.value = val;  // update the slider's internal value
+                    s.setAttribute('aria-valuenow', val);
+                    s.dispatchEvent(new Event('input', { bubbles: true }));
+                    s.dispatchEvent(new Event('change', { bubbles: true }));
+                """, slider, int(rating))
+
+                thumb = slider.find_element(By.XPATH, ".//span[contains(@style,'transform')]")
+                width = slider.size['width']
+                target_x = (rating / 10) * width - thumb.size['width'] / 2
+
+                actions = ActionChains(driver)
+                actions.click_and_hold(thumb).move_by_offset(target_x, 0).release().perform()
+
+                print("Rating set via slider.")
+
+                # todo: press save
+
+                pass # remove and readd update DB when above works as expected
+
+                # update DB entry
+                # c.execute(
+                #     "UPDATE movies SET in_plex_rating=1 WHERE title=? AND year=?",
+                #     (title, year),
+                # )
+                # conn.commit()
+
+            except Exception as e:
+                print(" Could not set rating:", e)
+
+        except Exception as e:
+            print(f"No results found for {title} ({year}): {e}")
+        break
+
+    conn.commit()
+
+
+def setPlexWatchHistoryAndRating(driver):
+    conn = db.get_conn()
+    c = conn.cursor()
+
+    c.execute("SELECT title, year, rating FROM movies WHERE in_plex_history=0 OR in_plex_rating=0")
+    films = c.fetchall()
+
+    wait = WebDriverWait(driver, 15)
+
+    for title, year, rating in films:
+        query = f"{title} {year}"
+        encoded_query = urllib.parse.quote(query)
+        url = f"https://app.plex.tv/desktop/#!/search?query={encoded_query}"
+        print(f"Searching Plex for: {title} ({year})")
+
+        driver.get(url)
+
+        try:
+            first_result = wait.until(
+                EC.presence_of_element_located(
+                    (By.CSS_SELECTOR, "div.SearchResultListRow-container-eOnSD1 a")
+                )
+            )
+            first_result.click()
+            print(f"Clicked first result for {title} ({year})")
+
+            # Handle history
+            try:
+                watch_button = WebDriverWait(driver, 10).until(
+                    EC.element_to_be_clickable((By.CSS_SELECTOR, 'button[data-testid="preplay-togglePlayedState"]'))
+                )
+                watch_button.click()
+                print(" Marked as Watched")
+                c.execute(
+                    "UPDATE movies SET in_plex_history=1 WHERE title=? AND year=?",
+                    (title, year),
+                )
+                conn.commit()
+            except Exception as e:
+                print(" Could not mark as watched:", e)
+
+            # Handle rating
+            try:
+                print(" Rating set")
+                c.execute(
+                    "UPDATE movies SET in_plex_rating=1 WHERE title=? AND year=?",
+                    (title, year),
+                )
+                conn.commit()
+            except Exception as e:
+                print(" Could not set rating:", e)
+
+        except Exception as e:
+            print(f"No results found for {title} ({year}): {e}")
+
+    conn.commit()
+
+
+# from selenium.webdriver.chrome.service import Service as ChromeService
+# from selenium.webdriver.firefox.service import Service as FirefoxService
+# from selenium.webdriver.edge.service import Service as EdgeService
+# from selenium.webdriver.chrome.options import Options as ChromeOptions
+# from selenium.webdriver.firefox.options import Options as FirefoxOptions
+# from selenium.webdriver.edge.options import Options as EdgeOptions
+# from selenium.webdriver.safari.webdriver import WebDriver as SafariDriver
+#
+# def get_default_profile(browser):
+#     system = platform.system().lower()
+#     home = os.path.expanduser("~")
+#
+#     if browser == "chrome":
+#         if system == "windows":
+#             return os.path.join(os.environ["LOCALAPPDATA"], "Google/Chrome/User Data")
+#         elif system == "darwin":  # macOS
+#             return os.path.join(home, "Library/Application Support/Google/Chrome")
+#         else:  # Linux
+#             return os.path.join(home, ".config/google-chrome")
+#
+#     if browser == "brave":
+#         if system == "windows":
+#             return os.path.join(os.environ["LOCALAPPDATA"], "BraveSoftware/Brave-Browser/User Data")
+#         elif system == "darwin":
+#             return os.path.join(home, "Library/Application Support/BraveSoftware/Brave-Browser")
+#         else:
+#             return os.path.join(home, ".config/BraveSoftware/Brave-Browser")
+#
+#     if browser == "edge":
+#         if system == "windows":
+#             return os.path.join(os.environ["LOCALAPPDATA"], "Microsoft/Edge/User Data")
+#         elif system == "darwin":
+#             return os.path.join(home, "Library/Application Support/Microsoft Edge")
+#         else:
+#             return os.path.join(home, ".config/microsoft-edge")
+#
+#     if browser == "firefox":
+#         if system == "windows":
+#             return os.path.join(os.environ["APPDATA"], "Mozilla/Firefox/Profiles")
+#         elif system == "darwin":
+#             return os.path.join(home, "Library/Application Support/Firefox/Profiles")
+#         else:
+#             return os.path.join(home, ".mozilla/firefox")
+#
+#     return None
+#
+# def get_driver_auto():
+#     system = platform.system().lower()
+#
+#     # Try detecting default browser name
+#     try:
+#         default_browser = webbrowser.get().name.lower()
+#     except:
+#         default_browser = ""
+#
+#     candidates = [
+#         ("chrome", "chromedriver", ChromeService, ChromeOptions),
+#         ("brave", "chromedriver", ChromeService, ChromeOptions),
+#         ("firefox", "geckodriver", FirefoxService, FirefoxOptions),
+#         ("edge", "msedgedriver", EdgeService, EdgeOptions),
+#     ]
+#
+#     # if system == "darwin":
+#     #     candidates.append(("safari", None, None, None))
+#
+#     for browser_name, driver_cmd, service_cls, options_cls in candidates:
+#         if browser_name in default_browser:
+#             if browser_name == "safari":
+#                 print("Launching Safari (default browser)")
+#                 return SafariDriver()
+#             elif driver_cmd and shutil.which(driver_cmd):
+#                 print(f"Launching {browser_name} (default browser)")
+#                 options = options_cls()
+#
+#                 # Try to attach to existing user profile
+#                 profile_path = get_default_profile(browser_name)
+#                 if profile_path and os.path.exists(profile_path):
+#                     options.add_argument(f"user-data-dir={profile_path}")
+#                     print(f"Using profile: {profile_path}")
+#
+#                 if browser_name in ("chrome", "brave"):
+#                     return webdriver.Chrome(service=service_cls(), options=options)
+#                 elif browser_name == "firefox":
+#                     return webdriver.Firefox(service=service_cls(), options=options)
+#                 elif browser_name == "edge":
+#                     return webdriver.Edge(service=service_cls(), options=options)
+#
+#     # Fallback loop
+#     for browser_name, driver_cmd, service_cls, options_cls in candidates:
+#         if browser_name == "safari" and system == "darwin":
+#             print("Launching Safari (fallback)")
+#             return SafariDriver()
+#         elif driver_cmd and shutil.which(driver_cmd):
+#             print(f"Launching {browser_name} (fallback)")
+#             options = options_cls()
+#
+#             profile_path = get_default_profile(browser_name)
+#             if profile_path and os.path.exists(profile_path):
+#                 options.add_argument(f"user-data-dir={profile_path}")
+#                 print(f"Using profile: {profile_path}")
+#
+#             if browser_name in ("chrome", "brave"):
+#                 return webdriver.Chrome(service=service_cls(), options=options)
+#             elif browser_name == "firefox":
+#                 return webdriver.Firefox(service=service_cls(), options=options)
+#             elif browser_name == "edge":
+#                 return webdriver.Edge(service=service_cls(), options=options)
+#
+#     raise RuntimeError("No supported browser/driver found.")
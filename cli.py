@@ -0,0 +1,106 @@
+"""Run syncs and pushes without the web app, e.g. from cron.
+
+    python cli.py sync recent|full|ratings|episodes|episodes-full [--force] [--restart]
+    python cli.py push history|ratings|all|episodes
+    python cli.py reconcile [--dry-run]
+    python cli.py rate
+    python cli.py import-ratings ratings.csv
+    python cli.py serve [--host 127.0.0.1] [--port 5000] [--threads 8]
+
+Modules are imported per command, so a sync never loads Flask or Selenium,
+and credentials are read (and the Trakt token refreshed) only when a
+command needs them.
+"""
+import argparse
+import json
+import sys
+
+
+def rateUnratedFilms():
+    import webbrowser
+
+    import db
+
+    c = db.get_conn().cursor()
+    c.execute("SELECT slug,title FROM unrated")
+    films = c.fetchall()
+
+    for slug, title in films:
+        url = f"https://trakt.tv/movies/{slug}"
+        choice = input(f"Do you want to rate '{title}'? [y/N]: ").strip().lower()
+        if choice == "y":
+            print(f"Opening {url}")
+            webbrowser.open(url)
+            # TODO: Poll Trakt for rating update and update DB
+        else:
+            print(f"Skipped {title}")
+
+
+def serve(host, port, threads):
+    """The dashboard without the debugger or reloader: waitress when installed,
+    otherwise Werkzeug's threaded server."""
+    import db
+    from Main import app
+
+    db.migrate()
+    try:
+        from waitress import serve as waitress_serve
+    except ImportError:
+        print("waitress not installed, using the threaded Werkzeug server")
+        app.run(host=host, port=port, threaded=True, debug=False, use_reloader=False)
+    else:
+        print(f"Serving on http://{host}:{port} with {threads} threads")
+        waitress_serve(app, host=host, port=port, threads=threads)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Trakt to Plex sync without the dashboard.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    sync_cmd = commands.add_parser("sync", help="pull history or ratings from Trakt")
+    sync_cmd.add_argument("mode", choices=("recent", "full", "ratings", "episodes", "episodes-full"))
+    sync_cmd.add_argument("--force", action="store_true", help="sync even if Trakt reports no new activity")
+    sync_cmd.add_argument("--restart", action="store_true", help="start a full (or episodes-full) import from page 1")
+
+    push_cmd = commands.add_parser("push", help="push watched state and ratings to Plex")
+    push_cmd.add_argument("mode", choices=("history", "ratings", "all", "episodes"))
+
+    reconcile_cmd = commands.add_parser("reconcile", help="send Trakt and Plex only what each is missing")
+    reconcile_cmd.add_argument("--dry-run", action="store_true", help="print the differences, send nothing")
+
+    commands.add_parser("rate", help="step through unrated films and open them on Trakt")
+
+    import_cmd = commands.add_parser("import-ratings", help="rate the films in an IMDb or Letterboxd CSV export")
+    import_cmd.add_argument("file")
+
+    serve_cmd = commands.add_parser("serve", help="run the dashboard for everyday use")
+    serve_cmd.add_argument("--host", default="127.0.0.1")
+    serve_cmd.add_argument("--port", type=int, default=5000)
+    serve_cmd.add_argument("--threads", type=int, default=8, help="request threads (waitress only)")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "sync":
+        import sync
+        sync.runSync(args.mode, sync.trakt_client(), force=args.force, restart=args.restart)
+    elif args.command == "push":
+        import push
+        push.runPush(args.mode)
+    elif args.command == "reconcile":
+        import reconcile
+        import sync
+        print(json.dumps(reconcile.runReconcile(sync.trakt_client(), dry_run=args.dry_run), indent=2))
+    elif args.command == "rate":
+        rateUnratedFilms()
+    elif args.command == "import-ratings":
+        import sync
+        with open(args.file, newline="", encoding="utf-8-sig") as f:
+            items = sync.readRatingsCSV(f)
+        sync.submitRatings(sync.trakt_client(), items)
+    elif args.command == "serve":
+        serve(args.host, args.port, args.threads)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+API_KEYS_FILE = "API_KEYS.json"
+TOKEN_FILE = "trakt_token.json"
+TRAKT_OAUTH = "https://api.trakt.tv/oauth"
+# refresh the Trakt token once it expires within this many seconds
+REFRESH_MARGIN = 24 * 3600
+
+# Settings from API_KEYS.json, read the first time one is used (config.SYNC_WORKERS, ...)
+# so importing a module costs nothing and a command that never pushes never needs Plex keys.
+SETTINGS = {
+    "CLIENT_ID": lambda keys: keys["Trakt_Client_ID"],
+    "CLIENT_SECRET": lambda keys: keys["Trakt_Client_Secret"],
+    # max concurrent Trakt page requests during a full sync
+    "SYNC_WORKERS": lambda keys: int(os.environ.get("TRAKT_SYNC_WORKERS", keys.get("Sync_Workers", 4))),
+    # size budget of the on-disk Trakt response cache (trakt_cache.db)
+    "TRAKT_CACHE_MB": lambda keys: int(keys.get("Trakt_Cache_MB", 64)),
+    # optional direct Plex Media Server access, falls back to Selenium when missing
+    "PLEX_URL": lambda keys: keys.get("Plex_URL"),
+    "PLEX_TOKEN": lambda keys: keys.get("Plex_Token"),
+    "PLEX_WORKERS": lambda keys: int(keys.get("Plex_Workers", 8)),
+    # run the Selenium fallback without a visible window (sign in once with it off)
+    "PLEX_HEADLESS": lambda keys: bool(keys.get("Plex_Headless", False)),
+    # browsers the Selenium fallback pushes with in parallel, each on a copy of the profile
+    "PLEX_BROWSER_WORKERS": lambda keys: int(keys.get("Plex_Browser_Workers", 1)),
+    # films Plex didn't have are not searched again until the library changes or this expires
+    "PLEX_MISS_TTL": lambda keys: int(keys.get("Plex_Miss_TTL_Days", 7)) * 24 * 3600,
+}
+
+_lock = threading.RLock()
+_api_keys = None
+_token = None
+
+
+def api_keys():
+    global _api_keys
+    with _lock:
+        if _api_keys is None:
+            with open(API_KEYS_FILE, "r") as f:
+                _api_keys = json.load(f)
+        return _api_keys
+
+
+def __getattr__(name):
+    if name not in SETTINGS:
+        raise AttributeError(f"module 'config' has no attribute {name!r}")
+    value = SETTINGS[name](api_keys())
+    globals()[name] = value  # computed once, later lookups don't come back here
+    return value
+
+
+# ---------- OAUTH HELPERS ----------
+def save_trakt_token(token):
+    with open(TOKEN_FILE, "w") as f:
+        json.dump(token, f, indent=2)
+
+
+def get_trakt_token(client_id, client_secret):
+    """Run Trakt device flow and save token to file."""
+    r = requests.post(f"{TRAKT_OAUTH}/device/code",
+                      json={"client_id": client_id})
+    r.raise_for_status()
+    device = r.json()
+    print(f"Go to {device['verification_url']} and enter code: {device['user_code']}")
+
+    while True:
+        time.sleep(device["interval"])
+        r = requests.post(f"{TRAKT_OAUTH}/device/token", json={
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "code": device["device_code"]
+        })
+        if r.status_code == 200:
+            token = r.json()
+            save_trakt_token(token)
+            print("Trakt authorization successful")
+            return token
+        elif r.status_code == 400:
+            # still pending
+            continue
+        elif r.status_code in (403, 404):
+            raise RuntimeError("Device code expired or invalid, restart flow")
+        else:
+            r.raise_for_status()
+
+
+def token_expiring(token):
+    """True when the token runs out within REFRESH_MARGIN (tokens without expiry info never do)."""
+    try:
+        expires_at = int(token["created_at"]) + int(token["expires_in"])
+    except (KeyError, TypeError, ValueError):
+        return False
+    return expires_at - time.time() < REFRESH_MARGIN
+
+
+def refresh_trakt_token(client_id, client_secret, token):
+    """Trade the refresh token for a new access token and save it."""
+    r = requests.post(f"{TRAKT_OAUTH}/token", json={
+        "refresh_token": token["refresh_token"],
+        "client_id": client_id,
+        "client_secret": client_secret,
+        "redirect_uri": "urn:ietf:wg:oauth:2.0:oob",
+        "grant_type": "refresh_token"
+    })
+    r.raise_for_status()
+    token = r.json()
+    save_trakt_token(token)
+    print("Trakt token refreshed")
+    return token
+
+
+def load_trakt_token(client_id, client_secret):
+    """Load access token from file (refreshing it when it is about to expire) or start new auth flow."""
+    if Path(TOKEN_FILE).exists():
+        with open(TOKEN_FILE, "r") as f:
+            token = json.load(f)
+        if token_expiring(token) and token.get("refresh_token"):
+            token = refresh_trakt_token(client_id, client_secret, token)
+        return token
+    return get_trakt_token(client_id, client_secret)
+
+
+def trakt_token():
+    """The current Trakt token, loaded on first use and refreshed before it expires."""
+    global _token
+    with _lock:
+        if _token is None or token_expiring(_token):
+            keys = api_keys()
+            _token = load_trakt_token(keys["Trakt_Client_ID"], keys["Trakt_Client_Secret"])
+        return _token
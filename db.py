@@ -0,0 +1,556 @@
+import queue
+import sqlite3
+import threading
+from pathlib import Path
+
+import metrics
+
+DB_FILE = "trakt_plex.db"
+
+# applied per connection; journal_mode=WAL is persistent and set once in migrate()
+PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",     # safe with WAL, avoids an fsync per commit
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",      # ~20MB page cache
+)
+
+# busy_timeout per connection kind. Writers wait out another writer's
+# transaction (a sync next to a ratings import); web reads give up sooner:
+# under WAL a reader only waits on a checkpoint or recovery, and a quick 503
+# beats a page that hangs.
+WRITE_BUSY_TIMEOUT_MS = 30000
+READ_BUSY_TIMEOUT_MS = 2000
+
+# ---------- MIGRATIONS ----------
+# Each entry is a list of statements applied once, in order.
+# PRAGMA user_version records how many have run.
+MIGRATIONS = [
+    # 1: base schema (IF NOT EXISTS so databases from before migrations upgrade cleanly)
+    [
+        """CREATE TABLE IF NOT EXISTS history (
+            history_id INTEGER PRIMARY KEY,     -- Trakt history event id
+            slug TEXT NOT NULL,                 -- trakt movie slug
+            imdb_id TEXT,
+            tmdb_id INTEGER,
+            title TEXT,
+            year INTEGER,
+            watched_at TEXT,
+            rated INTEGER DEFAULT 0,
+            rating INTEGER,
+            in_plex_history INTEGER DEFAULT 0,
+            in_plex_rating INTEGER DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS unrated (
+            slug TEXT PRIMARY KEY,
+            title TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,               -- e.g. history_watched_at
+            value TEXT
+        )""",
+    ],
+    # 2: indexes for slug/title lookups and the "still to do" queries
+    [
+        "CREATE INDEX IF NOT EXISTS idx_history_slug ON history(slug)",
+        "CREATE INDEX IF NOT EXISTS idx_history_title_year ON history(title, year)",
+        # partial indexes only hold the rows the queues actually ask for
+        "CREATE INDEX IF NOT EXISTS idx_history_unrated ON history(slug) WHERE rated=0",
+        "CREATE INDEX IF NOT EXISTS idx_history_plex_pending ON history(title, year) WHERE in_plex_history=0",
+        "CREATE INDEX IF NOT EXISTS idx_history_plex_rating_pending ON history(title, year) WHERE in_plex_rating=0 AND rated=1",
+    ],
+    # 3: keep unrated (and its row count) in step with history through triggers
+    [
+        """CREATE TABLE IF NOT EXISTS unrated_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total INTEGER NOT NULL
+        )""",
+        # a new play of a film we already rated inherits the rating,
+        # a play of an unrated film joins the queue
+        """CREATE TRIGGER IF NOT EXISTS history_after_insert AFTER INSERT ON history
+        WHEN NEW.rated = 0
+        BEGIN
+            UPDATE history
+               SET rated=1, rating=(SELECT h.rating FROM history h WHERE h.slug=NEW.slug AND h.rated=1 LIMIT 1)
+             WHERE history_id=NEW.history_id
+               AND EXISTS (SELECT 1 FROM history h WHERE h.slug=NEW.slug AND h.rated=1);
+            INSERT OR IGNORE INTO unrated (slug, title)
+            SELECT NEW.slug, NEW.title
+             WHERE NOT EXISTS (SELECT 1 FROM history h WHERE h.slug=NEW.slug AND h.rated=1);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS history_after_rated AFTER UPDATE OF rated ON history
+        WHEN NEW.rated = 1 AND OLD.rated = 0
+        BEGIN
+            DELETE FROM unrated WHERE slug=NEW.slug;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS unrated_after_insert AFTER INSERT ON unrated
+        BEGIN
+            UPDATE unrated_stats SET total = total + 1 WHERE id = 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS unrated_after_delete AFTER DELETE ON unrated
+        BEGIN
+            UPDATE unrated_stats SET total = total - 1 WHERE id = 1;
+        END""",
+        # one-off rebuild: drop films rated since the last scan, add any missing ones
+        "DELETE FROM unrated WHERE slug IN (SELECT slug FROM history WHERE rated=1)",
+        "INSERT OR IGNORE INTO unrated (slug, title) SELECT slug, title FROM history WHERE rated=0",
+        "INSERT OR REPLACE INTO unrated_stats (id, total) SELECT 1, COUNT(*) FROM unrated",
+    ],
+    # 4: local copy of the Plex movie library, keyed for GUID lookups
+    [
+        """CREATE TABLE IF NOT EXISTS plex_library (
+            rating_key TEXT PRIMARY KEY,        -- Plex ratingKey
+            section_key TEXT NOT NULL,
+            title TEXT,
+            year INTEGER,
+            imdb_id TEXT,
+            tmdb_id INTEGER,
+            updated_at INTEGER                  -- Plex updatedAt (epoch seconds)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_plex_library_imdb ON plex_library(imdb_id) WHERE imdb_id IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_plex_library_tmdb ON plex_library(tmdb_id) WHERE tmdb_id IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_plex_library_section ON plex_library(section_key)",
+    ],
+    # 5: remembered Plex matches per film, including films Plex doesn't have
+    [
+        """CREATE TABLE IF NOT EXISTS plex_match (
+            slug TEXT PRIMARY KEY,              -- trakt movie slug
+            found INTEGER NOT NULL,             -- 0 = not in the Plex library when checked
+            rating_key TEXT,                    -- Plex ratingKey (API path)
+            plex_url TEXT,                      -- app.plex.tv details page (Selenium path)
+            checked_at INTEGER NOT NULL         -- epoch seconds
+        )""",
+    ],
+    # 6: newest-first browsing of history (/films) without sorting the table
+    [
+        "CREATE INDEX IF NOT EXISTS idx_history_watched ON history(watched_at DESC, history_id DESC)",
+    ],
+    # 7: split history into one row per film (movies) and one compact row per play (watches);
+    # rating and Plex state now live on the film, history stays as a read-only view
+    [
+        """CREATE TABLE movies (
+            movie_id INTEGER PRIMARY KEY,
+            trakt_id INTEGER,                   -- Trakt movie id, NULL for films synced before this
+            slug TEXT NOT NULL UNIQUE,          -- trakt movie slug
+            imdb_id TEXT,
+            tmdb_id INTEGER,
+            title TEXT,
+            year INTEGER,
+            rated INTEGER DEFAULT 0,
+            rating INTEGER,
+            in_plex_history INTEGER DEFAULT 0,
+            in_plex_rating INTEGER DEFAULT 0
+        )""",
+        """CREATE TABLE watches (
+            history_id INTEGER PRIMARY KEY,     -- Trakt history event id
+            movie_id INTEGER NOT NULL REFERENCES movies(movie_id),
+            watched_at TEXT
+        )""",
+        # a film counts as rated / in Plex if any of its plays was
+        """INSERT INTO movies (slug, imdb_id, tmdb_id, title, year, rated, rating, in_plex_history, in_plex_rating)
+           SELECT slug, MAX(imdb_id), MAX(tmdb_id), MAX(title), MAX(year),
+                  MAX(rated), MAX(rating), MAX(in_plex_history), MAX(in_plex_rating)
+             FROM history GROUP BY slug""",
+        """INSERT INTO watches (history_id, movie_id, watched_at)
+           SELECT h.history_id, m.movie_id, h.watched_at FROM history h JOIN movies m ON m.slug = h.slug""",
+        "DROP TRIGGER IF EXISTS history_after_insert",
+        "DROP TRIGGER IF EXISTS history_after_rated",
+        "DROP TABLE history",
+        """CREATE VIEW history AS
+           SELECT w.history_id, m.slug, m.imdb_id, m.tmdb_id, m.title, m.year, w.watched_at,
+                  m.rated, m.rating, m.in_plex_history, m.in_plex_rating
+             FROM watches w JOIN movies m ON m.movie_id = w.movie_id""",
+        "CREATE INDEX idx_watches_watched ON watches(watched_at DESC, history_id DESC)",
+        "CREATE INDEX idx_watches_movie ON watches(movie_id)",
+        "CREATE INDEX idx_movies_plex_pending ON movies(movie_id) WHERE in_plex_history=0",
+        "CREATE INDEX idx_movies_plex_rating_pending ON movies(movie_id) WHERE in_plex_rating=0 AND rated=1",
+        # the unrated queue now follows the film instead of its plays
+        """CREATE TRIGGER movies_after_insert AFTER INSERT ON movies
+        WHEN NEW.rated = 0
+        BEGIN
+            INSERT OR IGNORE INTO unrated (slug, title) VALUES (NEW.slug, NEW.title);
+        END""",
+        """CREATE TRIGGER movies_after_rated AFTER UPDATE OF rated ON movies
+        WHEN NEW.rated = 1 AND OLD.rated = 0
+        BEGIN
+            DELETE FROM unrated WHERE slug=NEW.slug;
+        END""",
+        "DELETE FROM unrated WHERE slug IN (SELECT slug FROM movies WHERE rated=1)",
+        "INSERT OR IGNORE INTO unrated (slug, title) SELECT slug, title FROM movies WHERE rated=0",
+        "INSERT OR REPLACE INTO unrated_stats (id, total) SELECT 1, COUNT(*) FROM unrated",
+    ],
+    # 8: rating imports match films by IMDb id or by title and year
+    [
+        "CREATE INDEX idx_movies_imdb ON movies(imdb_id) WHERE imdb_id IS NOT NULL",
+        "CREATE INDEX idx_movies_title_year ON movies(title COLLATE NOCASE, year)",
+    ],
+    # 9: reconciliation matches Plex items to films by TMDB id when they have no IMDb id
+    [
+        "CREATE INDEX idx_movies_tmdb ON movies(tmdb_id) WHERE tmdb_id IS NOT NULL",
+    ],
+    # 10: TV history. Shows and episodes are keyed by their Trakt ids, so a play is
+    # three integers; titles are stored once per show and episode, never per play
+    [
+        """CREATE TABLE shows (
+            show_id INTEGER PRIMARY KEY,        -- Trakt show id
+            slug TEXT NOT NULL,
+            title TEXT,
+            year INTEGER,
+            imdb_id TEXT,
+            tmdb_id INTEGER,
+            tvdb_id INTEGER
+        )""",
+        """CREATE TABLE episodes (
+            episode_id INTEGER PRIMARY KEY,     -- Trakt episode id
+            show_id INTEGER NOT NULL REFERENCES shows(show_id),
+            season INTEGER NOT NULL,
+            number INTEGER NOT NULL,
+            title TEXT,
+            in_plex_history INTEGER DEFAULT 0
+        )""",
+        """CREATE TABLE episode_watches (
+            history_id INTEGER PRIMARY KEY,     -- Trakt history event id
+            episode_id INTEGER NOT NULL REFERENCES episodes(episode_id),
+            watched_at INTEGER NOT NULL         -- epoch seconds
+        )""",
+        # episodes only exist once watched, so this is the Plex push queue
+        "CREATE INDEX idx_episodes_plex_pending ON episodes(show_id, season, number) WHERE in_plex_history=0",
+    ],
+]
+
+_local = threading.local()
+_migrate_lock = threading.Lock()
+_migrated = False
+
+
+def connect(readonly=False, shared=False):
+    """Open a new connection with the tuned pragmas applied.
+
+    readonly opens the file with mode=ro so the connection can never take the
+    write lock; shared lets a pool hand the connection to other threads.
+    """
+    busy_timeout = READ_BUSY_TIMEOUT_MS if readonly else WRITE_BUSY_TIMEOUT_MS
+    if readonly:
+        conn = sqlite3.connect(Path(DB_FILE).resolve().as_uri() + "?mode=ro", uri=True,
+                               timeout=busy_timeout / 1000, check_same_thread=not shared)
+    else:
+        conn = sqlite3.connect(DB_FILE, timeout=busy_timeout / 1000, check_same_thread=not shared)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    conn.execute(f"PRAGMA busy_timeout={busy_timeout}")
+    if readonly:
+        conn.execute("PRAGMA query_only=1")
+    return conn
+
+
+def migrate():
+    """Bring the schema up to date. Cheap no-op after the first call."""
+    global _migrated
+    if _migrated:
+        return
+    with _migrate_lock:
+        if _migrated:
+            return
+        conn = connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            conn.execute("BEGIN")
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute(f"PRAGMA user_version={number}")
+            conn.commit()
+            print(f"Applied DB migration {number}")
+        conn.close()
+        _migrated = True
+
+
+def get_conn():
+    """Connection reused by every call on the current thread. Don't close it."""
+    migrate()
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = connect()
+    return conn
+
+
+class ConnectionPool:
+    """Connections handed out per web request and put back when it ends.
+
+    The threaded server runs each request on a fresh thread, so get_conn()
+    would open (and leak) a connection per request; this keeps up to
+    `max_idle` of them open between requests instead.
+    """
+
+    def __init__(self, readonly=False, max_idle=8):
+        self.readonly = readonly
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+
+    def acquire(self):
+        migrate()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect(readonly=self.readonly, shared=True)
+
+    def release(self, conn):
+        try:
+            conn.rollback()  # never park a connection mid-transaction
+            self._idle.put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+# ---------- STATE ----------
+def get_state(c, key, default=None):
+    c.execute("SELECT value FROM sync_state WHERE key=?", (key,))
+    row = c.fetchone()
+    return row[0] if row else default
+
+
+def set_state(c, key, value):
+    c.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
+
+
+def unrated_count(c):
+    """Size of the unrated queue, kept by triggers so this never scans."""
+    c.execute("SELECT total FROM unrated_stats WHERE id = 1")
+    row = c.fetchone()
+    return row[0] if row else 0
+
+
+# ---------- READS ----------
+@metrics.timed("db.films_page")
+def films_page(c, limit, before=None):
+    """Newest-first history rows after the keyset cursor (watched_at, history_id).
+
+    Rows are (slug, title, rating, watched_at, year, history_id); pass the last
+    row's (watched_at, history_id) as `before` to get the next page.
+    """
+    if before is None:
+        c.execute("""SELECT slug, title, rating, watched_at, year, history_id FROM history
+                     ORDER BY watched_at DESC, history_id DESC LIMIT ?""", (limit,))
+    else:
+        c.execute("""SELECT slug, title, rating, watched_at, year, history_id FROM history
+                     WHERE (watched_at, history_id) < (?, ?)
+                     ORDER BY watched_at DESC, history_id DESC LIMIT ?""", (*before, limit))
+    return c.fetchall()
+
+
+# ---------- BULK WRITES ----------
+@metrics.timed("db.insert_history")
+def insert_history(c, rows):
+    """rows: (history_id, trakt_id, slug, imdb_id, tmdb_id, title, year, watched_at) tuples.
+
+    Adds each film once to movies and each play to watches.
+    """
+    rows = rows if isinstance(rows, list) else list(rows)
+    metrics.inc("db_rows_total", len(rows), table="watches")
+    c.executemany("""
+        INSERT INTO movies (trakt_id, slug, imdb_id, tmdb_id, title, year)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (slug) DO UPDATE SET trakt_id = COALESCE(movies.trakt_id, excluded.trakt_id)
+    """, [row[1:7] for row in rows])
+    c.executemany("""
+        INSERT OR IGNORE INTO watches (history_id, movie_id, watched_at)
+        SELECT ?, movie_id, ? FROM movies WHERE slug = ?
+    """, [(row[0], row[7], row[2]) for row in rows])
+
+
+@metrics.timed("db.insert_episode_history")
+def insert_episode_history(c, rows):
+    """rows: (history_id, show, episode, watched_at) with show as
+    (show_id, slug, title, year, imdb_id, tmdb_id, tvdb_id), episode as
+    (episode_id, show_id, season, number, title) and watched_at in epoch seconds.
+
+    A page repeats the same few shows and episodes many times, so each is
+    written once per batch.
+    """
+    rows = rows if isinstance(rows, list) else list(rows)
+    metrics.inc("db_rows_total", len(rows), table="episode_watches")
+    shows = {row[1][0]: row[1] for row in rows}
+    episodes = {row[2][0]: row[2] for row in rows}
+    c.executemany("INSERT OR IGNORE INTO shows VALUES (?, ?, ?, ?, ?, ?, ?)", list(shows.values()))
+    c.executemany("INSERT OR IGNORE INTO episodes (episode_id, show_id, season, number, title) VALUES (?, ?, ?, ?, ?)",
+                  list(episodes.values()))
+    c.executemany("INSERT OR IGNORE INTO episode_watches VALUES (?, ?, ?)",
+                  [(row[0], row[2][0], row[3]) for row in rows])
+
+
+@metrics.timed("db.stage_ratings")
+def stage_ratings(c, ratings, clear=False):
+    """Add (slug, rating) pairs to the connection's temp staging table."""
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS staged_ratings (slug TEXT PRIMARY KEY, rating INTEGER)")
+    if clear:
+        c.execute("DELETE FROM staged_ratings")
+    c.executemany("INSERT OR REPLACE INTO staged_ratings (slug, rating) VALUES (?, ?)", ratings)
+    metrics.inc("db_rows_total", len(ratings), table="staged_ratings")
+
+
+@metrics.timed("db.apply_staged_ratings")
+def apply_staged_ratings(c):
+    """Apply everything staged with one joined UPDATE, films that already
+    hold the same rating are left alone."""
+    c.execute("""
+        UPDATE movies SET rated=1, rating=s.rating
+        FROM staged_ratings AS s
+        WHERE movies.slug = s.slug
+          AND (movies.rated = 0 OR movies.rating IS NOT s.rating)
+    """)
+    c.execute("DELETE FROM staged_ratings")
+
+
+def apply_ratings(c, ratings):
+    """ratings: (slug, rating) pairs for films already in movies."""
+    stage_ratings(c, ratings, clear=True)
+    apply_staged_ratings(c)
+
+
+@metrics.timed("db.apply_rating_matches")
+def apply_rating_matches(c, rows):
+    """Ratings Trakt accepted, as (slug, imdb_id, title, year, rating).
+
+    Imports rarely carry a slug, so each row is matched by slug, else IMDb id,
+    else title and year, one indexed UPDATE per key. Films we have no play of
+    are skipped; the next ratings sync won't add them either.
+    """
+    c.execute("""CREATE TEMP TABLE IF NOT EXISTS accepted_ratings (
+        slug TEXT, imdb_id TEXT, title TEXT, year INTEGER, rating INTEGER)""")
+    c.execute("DELETE FROM accepted_ratings")
+    c.executemany("INSERT INTO accepted_ratings VALUES (?, ?, ?, ?, ?)", rows)
+    metrics.inc("db_rows_total", len(rows), table="accepted_ratings")
+    for match, only in (
+        ("movies.slug = a.slug", "a.slug IS NOT NULL"),
+        ("movies.imdb_id = a.imdb_id", "a.slug IS NULL AND a.imdb_id IS NOT NULL"),
+        ("movies.title = a.title COLLATE NOCASE AND movies.year = a.year", "a.slug IS NULL AND a.imdb_id IS NULL"),
+    ):
+        c.execute(f"""
+            UPDATE movies SET rated=1, rating=a.rating
+            FROM accepted_ratings AS a
+            WHERE {match} AND {only}
+              AND (movies.rated = 0 OR movies.rating IS NOT a.rating)
+        """)
+    c.execute("DELETE FROM accepted_ratings")
+
+
+@metrics.timed("db.apply_plex_state")
+def apply_plex_state(c, rows):
+    """What Plex shows per film, as (imdb_id, tmdb_id, watched, rating), copied
+    onto in_plex_history/in_plex_rating so pushes only send what Plex lacks.
+
+    Films Plex doesn't have keep their flags.
+    """
+    c.execute("""CREATE TEMP TABLE IF NOT EXISTS plex_state (
+        imdb_id TEXT, tmdb_id INTEGER, watched INTEGER, rating INTEGER)""")
+    c.execute("DELETE FROM plex_state")
+    c.executemany("INSERT INTO plex_state VALUES (?, ?, ?, ?)", rows)
+    metrics.inc("db_rows_total", len(rows), table="plex_state")
+    for match in ("movies.imdb_id = p.imdb_id", "p.imdb_id IS NULL AND movies.tmdb_id = p.tmdb_id"):
+        c.execute(f"""
+            UPDATE movies SET in_plex_history = p.watched,
+                              in_plex_rating = (movies.rated = 1 AND movies.rating IS p.rating)
+            FROM plex_state AS p
+            WHERE {match}
+        """)
+    c.execute("DELETE FROM plex_state")
+
+
+@metrics.timed("db.upsert_plex_library")
+def upsert_plex_library(c, rows):
+    """rows: (rating_key, section_key, title, year, imdb_id, tmdb_id, updated_at) tuples."""
+    c.executemany("""
+        INSERT OR REPLACE INTO plex_library (
+            rating_key, section_key, title, year,
+            imdb_id, tmdb_id, updated_at
+        ) VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    metrics.inc("db_rows_total", len(rows), table="plex_library")
+
+
+def plex_key_for(c, imdb_id, tmdb_id):
+    """Plex rating key for a film by IMDb id, then TMDB id. None if not in the library."""
+    if imdb_id:
+        c.execute("SELECT rating_key FROM plex_library WHERE imdb_id=? LIMIT 1", (imdb_id,))
+        row = c.fetchone()
+        if row:
+            return row[0]
+    if tmdb_id:
+        c.execute("SELECT rating_key FROM plex_library WHERE tmdb_id=? LIMIT 1", (tmdb_id,))
+        row = c.fetchone()
+        if row:
+            return row[0]
+    return None
+
+
+def get_plex_match(c, slug):
+    """(found, rating_key, plex_url, checked_at) for a film, or None if never looked up."""
+    c.execute("SELECT found, rating_key, plex_url, checked_at FROM plex_match WHERE slug=?", (slug,))
+    return c.fetchone()
+
+
+@metrics.timed("db.record_plex_matches")
+def record_plex_matches(c, rows):
+    """rows: (slug, found, rating_key, plex_url, checked_at) tuples."""
+    c.executemany("""
+        INSERT OR REPLACE INTO plex_match (slug, found, rating_key, plex_url, checked_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, rows)
+    metrics.inc("db_rows_total", len(rows), table="plex_match")
+
+
+def forget_stale_plex_matches(c):
+    """Drop cached hits whose Plex item is no longer in the library index."""
+    c.execute("""
+        DELETE FROM plex_match
+         WHERE rating_key IS NOT NULL
+           AND rating_key NOT IN (SELECT rating_key FROM plex_library)
+    """)
+
+
+def clear_plex_section(c, section_key):
+    c.execute("DELETE FROM plex_library WHERE section_key=?", (section_key,))
+
+
+def plex_section_count(c, section_key):
+    c.execute("SELECT COUNT(*) FROM plex_library WHERE section_key=?", (section_key,))
+    return c.fetchone()[0]
+
+
+# ---------- PUSH QUEUES ----------
+def films_not_in_plex(c, ratings=False):
+    """(slug, imdb_id, tmdb_id, title, year) of films whose play, or with ratings=True
+    whose rating (added as a sixth field), Plex doesn't have yet."""
+    if ratings:
+        c.execute("""SELECT slug, imdb_id, tmdb_id, title, year, rating
+                     FROM movies WHERE in_plex_rating=0 AND rated=1""")
+    else:
+        # one request per film, not per play
+        c.execute("SELECT slug, imdb_id, tmdb_id, title, year FROM movies WHERE in_plex_history=0")
+    return c.fetchall()
+
+
+@metrics.timed("db.mark_films_in_plex")
+def mark_films_in_plex(c, slugs, ratings=False):
+    column = "in_plex_rating" if ratings else "in_plex_history"
+    c.executemany(f"UPDATE movies SET {column}=1 WHERE slug=?", [(slug,) for slug in slugs])
+
+
+def episodes_not_in_plex(c):
+    """(episode_id, tvdb_id, tmdb_id, imdb_id, show title, season, number) of
+    episodes not yet marked watched in Plex."""
+    c.execute("""SELECT e.episode_id, s.tvdb_id, s.tmdb_id, s.imdb_id, s.title, e.season, e.number
+                 FROM episodes e JOIN shows s ON s.show_id = e.show_id
+                 WHERE e.in_plex_history=0""")
+    return c.fetchall()
+
+
+@metrics.timed("db.mark_episodes_in_plex")
+def mark_episodes_in_plex(c, episode_ids):
+    c.executemany("UPDATE episodes SET in_plex_history=1 WHERE episode_id=?",
+                  [(episode_id,) for episode_id in episode_ids])
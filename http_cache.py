@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import db
+
+# stored alongside trakt_plex.db
+CACHE_FILE = os.path.join(os.path.dirname(db.DB_FILE), "trakt_cache.db")
+
+# response headers worth replaying from a cached page
+KEEP_HEADERS = ("Content-Type", "ETag", "Last-Modified",
+                "X-Pagination-Page", "X-Pagination-Limit",
+                "X-Pagination-Page-Count", "X-Pagination-Item-Count")
+
+
+class ResponseCache:
+    """On-disk cache of GET responses revalidated with ETag / Last-Modified.
+
+    Bounded by total body size (least recently used go first) and by age.
+    One connection guarded by a lock, so it can be shared between threads.
+    """
+
+    def __init__(self, path=CACHE_FILE, max_bytes=64 * 1024 * 1024, max_age=7 * 24 * 3600,
+                 max_entry_bytes=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS http_cache (
+            key TEXT PRIMARY KEY,               -- sha1 of url, params and credentials
+            etag TEXT,
+            last_modified TEXT,
+            headers TEXT,                       -- JSON of KEEP_HEADERS
+            body BLOB,
+            size INTEGER NOT NULL,
+            stored_at REAL NOT NULL,
+            used_at REAL NOT NULL
+        )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_http_cache_used ON http_cache(used_at)")
+        self._conn.commit()
+
+    @staticmethod
+    def key(url, params, identity=""):
+        raw = json.dumps([url, sorted((params or {}).items()), identity], default=str)
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def lookup(self, key):
+        """(etag, last_modified, headers, body) for a fresh entry, else None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT etag, last_modified, headers, body, stored_at FROM http_cache WHERE key=?",
+                (key,)).fetchone()
+        if row is None or time.time() - row[4] > self.max_age:
+            return None
+        return row[:4]
+
+    @staticmethod
+    def validators(entry):
+        """Conditional request headers for a cached entry."""
+        headers = {}
+        if entry is not None:
+            etag, last_modified = entry[0], entry[1]
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def hit(self, key, entry, r):
+        """Turn a 304 into the cached 200 response."""
+        self.hits += 1
+        with self._lock:
+            # revalidated, so it counts as fresh again
+            now = time.time()
+            self._conn.execute("UPDATE http_cache SET stored_at=?, used_at=? WHERE key=?", (now, now, key))
+            self._conn.commit()
+        headers = CaseInsensitiveDict(json.loads(entry[2]))
+        cached = requests.Response()
+        cached.status_code = 200
+        cached._content = entry[3]
+        cached.headers = headers
+        cached.url = r.url
+        cached.encoding = "utf-8"
+        cached.request = r.request
+        return cached
+
+    @staticmethod
+    def cacheable(r):
+        return r.status_code == 200 and bool(r.headers.get("ETag") or r.headers.get("Last-Modified"))
+
+    def store(self, key, r, body=None):
+        """Keep a 200 response that carries a validator, then enforce the bounds.
+
+        Pass `body` for streamed responses whose content was read elsewhere.
+        """
+        if not self.cacheable(r):
+            return
+        etag = r.headers.get("ETag")
+        last_modified = r.headers.get("Last-Modified")
+        if body is None:
+            body = r.content
+        if len(body) > self.max_entry_bytes:
+            return
+        headers = {name: r.headers[name] for name in KEEP_HEADERS if name in r.headers}
+        now = time.time()
+        with self._lock:
+            self._conn.execute("""
+                INSERT OR REPLACE INTO http_cache (key, etag, last_modified, headers, body, size, stored_at, used_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (key, etag, last_modified, json.dumps(headers), body, len(body), now, now))
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM http_cache WHERE stored_at < ?", (now - self.max_age,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM http_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # drop least recently used entries until we're back under budget
+        freed = 0
+        doomed = []
+        for key, size in self._conn.execute("SELECT key, size FROM http_cache ORDER BY used_at"):
+            if total - freed <= self.max_bytes:
+                break
+            doomed.append((key,))
+            freed += size
+        self._conn.executemany("DELETE FROM http_cache WHERE key=?", doomed)
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,156 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import metrics
+
+# how many finished jobs stay queryable
+KEEP_JOBS = 50
+
+_current = threading.local()
+
+
+class Job:
+    """One background task and its progress, safe to update from any thread."""
+
+    def __init__(self, kind, mode, name):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.mode = mode                # one of a fixed set per kind, labels the job's metrics
+        self.name = name                # for display only
+        self.status = "queued"          # queued -> running -> done | failed
+        self.done = 0
+        self.total = None
+        self.message = ""
+        self.error = None
+        self.result = None              # whatever fn returned, if JSON-friendly (e.g. a report)
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.spans = {}                 # span name -> [count, seconds], see metrics.py
+        self._lock = threading.Lock()
+
+    def progress(self, done=None, total=None, advance=0, message=None):
+        with self._lock:
+            if total is not None:
+                self.total = total
+            if done is not None:
+                self.done = done
+            self.done += advance
+            if message is not None:
+                self.message = message
+
+    @property
+    def label(self):
+        """kind and mode, the bounded value metrics are labelled with."""
+        return f"{self.kind} {self.mode}"
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def rate(self):
+        """Items per second since the job started."""
+        elapsed = self.elapsed
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "id": self.id,
+                "kind": self.kind,
+                "mode": self.mode,
+                "name": self.name,
+                "status": self.status,
+                "done": self.done,
+                "total": self.total,
+                "rate": round(self.rate, 2),
+                "elapsed": round(self.elapsed, 1),
+                "message": self.message,
+                "error": self.error,
+                "result": self.result,
+                "spans": metrics.summarize(self.spans),
+            }
+
+
+class JobRunner:
+    """Runs jobs on a small worker pool, at most one active job per kind.
+
+    Submitting a kind that is already queued or running returns the existing
+    job instead of starting a second one. `mode` must come from a fixed set,
+    it ends up in metric labels; `name` is free-form and only displayed.
+    """
+
+    def __init__(self, max_workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self.jobs = OrderedDict()
+        self.active = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, mode, name, fn, *args, **kwargs):
+        with self._lock:
+            running = self.active.get(kind)
+            if running is not None:
+                return running
+            job = Job(kind, mode, name)
+            self.active[kind] = job
+            self.jobs[job.id] = job
+            while len(self.jobs) > KEEP_JOBS:
+                oldest = next(iter(self.jobs.values()))
+                if oldest.active:
+                    break
+                self.jobs.popitem(last=False)
+        self.executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        _current.job = job
+        job.started_at = time.time()
+        job.status = "running"
+        try:
+            with metrics.scoped(job.label, job.spans):
+                result = fn(*args, **kwargs)
+            if isinstance(result, dict):
+                job.result = result
+            job.status = "done"
+        except Exception as e:
+            # don't leave half a page of writes open on this worker's connection
+            db.get_conn().rollback()
+            job.error = str(e)
+            job.status = "failed"
+            print(f"Job {job.name} failed: {e}")
+        finally:
+            job.finished_at = time.time()
+            _current.job = None
+            metrics.job_finished(job)
+            with self._lock:
+                if self.active.get(job.kind) is job:
+                    del self.active[job.kind]
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def recent(self):
+        return list(reversed(self.jobs.values()))
+
+
+def current():
+    """The job running on this thread, or None when called outside a job."""
+    return getattr(_current, "job", None)
+
+
+def progress(done=None, total=None, advance=0, message=None):
+    """Report progress for the current job, a no-op outside of one."""
+    job = current()
+    if job is not None:
+        job.progress(done=done, total=total, advance=advance, message=message)
@@ -0,0 +1,193 @@
+"""In-process timing spans and counters, rendered in the Prometheus text format.
+
+Everything is tagged with the mode of the job doing the work ("sync full",
+"push history", ...), taken from a thread-local scope the job runner sets.
+Pool and writer threads join their job's scope through bind().
+"""
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = "trakt_to_plex_"
+
+# seconds; fine at the low end for DB batches, coarse at the top for pacing pauses
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+HELP = {
+    "span_seconds": "Time spent in instrumented operations, by span and mode.",
+    "trakt_responses_total": "Trakt API responses by status code.",
+    "plex_responses_total": "Plex Media Server responses by status code.",
+    "db_rows_total": "Rows handed to bulk database writes.",
+    "jobs_total": "Finished background jobs by status.",
+    "job_duration_seconds": "Wall time of finished background jobs.",
+    "job_items_total": "Items processed by finished background jobs.",
+    "job_items_per_second": "Throughput of the last finished job of each mode.",
+    "job_last_success_timestamp_seconds": "When each mode last finished successfully.",
+}
+
+_lock = threading.Lock()
+_counters = {}      # (name, labels) -> value
+_gauges = {}        # (name, labels) -> value
+_histograms = {}    # (name, labels) -> [bucket counts..., sum, count]
+_scope = threading.local()
+
+
+# ---------- SCOPE ----------
+def mode():
+    return getattr(_scope, "mode", None) or "none"
+
+
+@contextmanager
+def scoped(mode, summary=None):
+    """Tag everything recorded on this thread with `mode`; spans are also
+    added up in `summary` (name -> [count, seconds]) when given."""
+    previous = getattr(_scope, "mode", None), getattr(_scope, "summary", None)
+    _scope.mode, _scope.summary = mode, summary
+    try:
+        yield
+    finally:
+        _scope.mode, _scope.summary = previous
+
+
+def bind(fn):
+    """fn wrapped to record into the calling thread's scope wherever it runs."""
+    current = getattr(_scope, "mode", None), getattr(_scope, "summary", None)
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        with scoped(*current):
+            return fn(*args, **kwargs)
+    return run
+
+
+# ---------- RECORDING ----------
+def _labels(labels):
+    # values as strings, so status="error" and status=200 series still sort together
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    labels.setdefault("mode", mode())
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[(name, _labels(labels))] = value
+
+
+def observe(name, seconds, **labels):
+    key = (name, _labels(labels))
+    with _lock:
+        values = _histograms.get(key)
+        if values is None:
+            values = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                values[i] += 1
+        values[-2] += seconds
+        values[-1] += 1
+
+
+def record_span(name, seconds):
+    observe("span_seconds", seconds, span=name, mode=mode())
+    summary = getattr(_scope, "summary", None)
+    if summary is not None:
+        with _lock:
+            entry = summary.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+
+@contextmanager
+def span(name):
+    """Time the block as `name`, whether it finishes or raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """Decorator form of span()."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return run
+    return decorate
+
+
+def sleep(seconds, name="pacing.sleep"):
+    """time.sleep that shows up as a span, for deliberate pauses."""
+    with span(name):
+        time.sleep(seconds)
+
+
+def job_finished(job):
+    """Job-level series used for duration and throughput alerts."""
+    inc("jobs_total", mode=job.label, status=job.status)
+    observe("job_duration_seconds", job.elapsed, mode=job.label, status=job.status)
+    inc("job_items_total", job.done, mode=job.label)
+    if job.status == "done":
+        set_gauge("job_items_per_second", job.rate, mode=job.label)
+        set_gauge("job_last_success_timestamp_seconds", job.finished_at, mode=job.label)
+
+
+def summarize(summary):
+    """Per-job span totals as plain dicts, slowest first."""
+    with _lock:
+        items = sorted(summary.items(), key=lambda item: item[1][1], reverse=True)
+        return {name: {"count": count, "seconds": round(seconds, 3)} for name, (count, seconds) in items}
+
+
+# ---------- EXPOSITION ----------
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _series(name, labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return PREFIX + name
+    return PREFIX + name + "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _header(lines, name, kind):
+    lines.append(f"# HELP {PREFIX}{name} {HELP.get(name, name)}")
+    lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+
+def render():
+    """Everything recorded so far in the Prometheus text exposition format."""
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        histograms = sorted((key, list(values)) for key, values in _histograms.items())
+
+    lines = []
+    for kind, series in (("counter", counters), ("gauge", gauges)):
+        seen = None
+        for (name, labels), value in series:
+            if name != seen:
+                _header(lines, name, kind)
+                seen = name
+            lines.append(f"{_series(name, labels)} {value}")
+
+    seen = None
+    for (name, labels), values in histograms:
+        if name != seen:
+            _header(lines, name, "histogram")
+            seen = name
+        # buckets are stored per bound already, which is what Prometheus wants (cumulative)
+        for bound, count in zip(BUCKETS, values):
+            lines.append(f"{_series(name + '_bucket', labels, [('le', bound)])} {count}")
+        lines.append(f"{_series(name + '_bucket', labels, [('le', '+Inf')])} {values[-1]}")
+        lines.append(f"{_series(name + '_sum', labels)} {values[-2]:.6f}")
+        lines.append(f"{_series(name + '_count', labels)} {values[-1]}")
+    return "\n".join(lines) + "\n"
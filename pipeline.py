@@ -0,0 +1,152 @@
+import codecs
+import json
+import queue
+import threading
+from collections import deque
+
+import db
+import metrics
+
+
+# ---------- FETCH / PARSE ----------
+def iter_json_array(chunks):
+    """Yield the elements of a top-level JSON array as its bytes arrive.
+
+    Only the unparsed tail of the stream is kept in memory, so a page costs
+    about one element of memory no matter how large the page is.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    started = False
+    finished = False
+    chunks = iter(chunks)
+
+    while not finished:
+        chunk = next(chunks, None)
+        final = chunk is None
+        buf += text.decode(b"" if final else chunk, final=final)
+        pos = 0
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or (started and buf[pos] == ",")):
+                pos += 1
+            if pos >= len(buf):
+                break
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError("expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                finished = True
+                break
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                break  # element not complete yet
+            if not final and not isinstance(item, (dict, list, str)) and (
+                    end >= len(buf) or not (buf[end].isspace() or buf[end] in ",]")):
+                break  # a number or literal could still continue in the next chunk
+            yield item
+            pos = end
+        buf = buf[pos:]
+        if final and not finished:
+            raise ValueError("JSON array was cut off")
+
+
+def batched(iterable, size):
+    """Lists of up to `size` items."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ordered_map(pool, fn, items, window):
+    """Like pool.map, but with at most `window` calls in flight or waiting to be
+    consumed, so finished-but-unwritten results can't pile up."""
+    pending = deque()
+    items = iter(items)
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= window:
+            break
+    while pending:
+        result = pending.popleft().result()
+        nxt = next(items, None)
+        if nxt is not None:
+            pending.append(pool.submit(fn, nxt))
+        yield result
+
+
+# ---------- WRITE ----------
+_STOP = object()
+
+
+class DBWriter:
+    """One thread that owns a connection and applies queued writes in order.
+
+    put(fn, *args) queues fn(cursor, *args); commit=True commits after it.
+    The queue is bounded, so a producer that outruns SQLite waits instead of
+    buffering. Use as a context manager: leaving commits and joins (or rolls
+    back if the producer raised), and re-raises the first write error.
+    """
+
+    def __init__(self, max_queue=8):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.aborted = False
+        # the writer records its spans under the job that created it
+        self.thread = threading.Thread(target=metrics.bind(self._run), name="db-writer", daemon=True)
+
+    def __enter__(self):
+        db.migrate()
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # if the producer failed, whatever wasn't committed yet is dropped
+        self.aborted = exc_type is not None
+        self.queue.put(_STOP)
+        self.thread.join()
+        if exc_type is None and self.error is not None:
+            raise self.error
+        return False
+
+    def put(self, fn, *args, commit=False):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((fn, args, commit))
+
+    def _run(self):
+        conn = db.connect()
+        c = conn.cursor()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is _STOP:
+                    break
+                if self.error is not None:
+                    continue  # drain so the producer never blocks on a dead writer
+                fn, args, commit = item
+                try:
+                    fn(c, *args)
+                    if commit:
+                        with metrics.span("db.commit"):
+                            conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    self.error = e
+            if self.error is None and not self.aborted:
+                conn.commit()
+            else:
+                conn.rollback()
+        finally:
+            conn.close()
@@ -0,0 +1,147 @@
+import re
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# library identifier PMS expects on the scrobble / rate endpoints
+LIBRARY_IDENTIFIER = "com.plexapp.plugins.library"
+
+# legacy agents put a single guid like com.plexapp.agents.imdb://tt0111161?lang=en on the item
+LEGACY_GUID = re.compile(r"agents\.(imdb|themoviedb)://([^?]+)")
+LEGACY_TVDB = re.compile(r"agents\.thetvdb://(\d+)")
+
+
+def external_ids(item):
+    """(imdb_id, tmdb_id) from a Plex metadata item, either may be None."""
+    imdb_id, tmdb_id = None, None
+    guids = [g["id"] for g in item.get("Guid", [])]
+    for guid in guids:
+        if guid.startswith("imdb://"):
+            imdb_id = guid[len("imdb://"):]
+        elif guid.startswith("tmdb://") and guid[len("tmdb://"):].isdigit():
+            tmdb_id = int(guid[len("tmdb://"):])
+    legacy = LEGACY_GUID.search(item.get("guid", ""))
+    if legacy:
+        agent, value = legacy.groups()
+        if agent == "imdb" and imdb_id is None:
+            imdb_id = value
+        elif agent == "themoviedb" and tmdb_id is None and value.isdigit():
+            tmdb_id = int(value)
+    return imdb_id, tmdb_id
+
+
+def tvdb_id(item):
+    """TVDB id of a Plex show, or None."""
+    for guid in item.get("Guid", []):
+        value = guid["id"][len("tvdb://"):]
+        if guid["id"].startswith("tvdb://") and value.isdigit():
+            return int(value)
+    legacy = LEGACY_TVDB.search(item.get("guid", ""))
+    return int(legacy.group(1)) if legacy else None
+
+
+class PlexClient:
+    """Talks to a Plex Media Server directly over its HTTP API.
+
+    One pooled session is shared by every call, so the push functions can
+    run several requests at once from a thread pool.
+    """
+
+    def __init__(self, base_url, token, pool_size=8, timeout=15):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Accept": "application/json",
+            "X-Plex-Token": token,
+            "X-Plex-Product": "TraktToPlex",
+            "X-Plex-Client-Identifier": "trakt-to-plex",
+        })
+
+    def _request(self, method, path, **params):
+        with metrics.span("plex.request"):
+            r = self.session.request(method, self.base_url + path, params=params, timeout=self.timeout)
+        metrics.inc("plex_responses_total", status=r.status_code)
+        r.raise_for_status()
+        return r
+
+    def _container(self, path, **params):
+        r = self._request("GET", path, **params)
+        if not r.content:
+            return {}
+        return r.json().get("MediaContainer", {})
+
+    def movie_sections(self):
+        """Library sections holding movies."""
+        directories = self._container("/library/sections").get("Directory", [])
+        return [d for d in directories if d.get("type") == "movie"]
+
+    def show_sections(self):
+        """Library sections holding TV shows."""
+        directories = self._container("/library/sections").get("Directory", [])
+        return [d for d in directories if d.get("type") == "show"]
+
+    def section_size(self, section_key):
+        """Number of movies in a section without fetching any of them."""
+        container = self._container(f"/library/sections/{section_key}/all", type=1,
+                                    **{"X-Plex-Container-Start": 0, "X-Plex-Container-Size": 0})
+        return int(container.get("totalSize", container.get("size", 0)))
+
+    def section_movies(self, section_key, updated_since=None, page_size=500):
+        """Yield every movie in a section, or only those updated after updated_since (epoch seconds)."""
+        params = {"type": 1, "includeGuids": 1}
+        if updated_since:
+            # ">>=" is Plex's greater-than for integer and date fields, a plain ">=" means "ends with"
+            params["updatedAt>>"] = updated_since
+        return self._paged(f"/library/sections/{section_key}/all", params, page_size)
+
+    def section_shows(self, section_key, page_size=500):
+        """Yield every show in a section, with its GUIDs."""
+        return self._paged(f"/library/sections/{section_key}/all", {"type": 2, "includeGuids": 1}, page_size)
+
+    def section_episodes(self, section_key, page_size=500):
+        """Yield every episode in a section; each names its show (grandparentRatingKey),
+        season (parentRatingKey, parentIndex) and episode number (index)."""
+        return self._paged(f"/library/sections/{section_key}/all", {"type": 4}, page_size)
+
+    def _paged(self, path, params, page_size):
+        start = 0
+        while True:
+            container = self._container(path, **params,
+                                        **{"X-Plex-Container-Start": start, "X-Plex-Container-Size": page_size})
+            items = container.get("Metadata", [])
+            yield from items
+            start += len(items)
+            if not items or start >= int(container.get("totalSize", start)):
+                break
+
+    def find_movie(self, title, year, sections=None):
+        """Rating key of the best title/year match, or None if not in the library."""
+        if sections is None:
+            sections = self.movie_sections()
+        for section in sections:
+            items = self._container(f"/library/sections/{section['key']}/all",
+                                    type=1, title=title, year=year).get("Metadata", [])
+            if not items:
+                continue
+            # the title filter is a substring match, prefer an exact title
+            for item in items:
+                if item.get("title", "").casefold() == title.casefold():
+                    return item["ratingKey"]
+            return items[0]["ratingKey"]
+        return None
+
+    def mark_watched(self, rating_key):
+        self._request("GET", "/:/scrobble", key=rating_key, identifier=LIBRARY_IDENTIFIER)
+
+    def rate(self, rating_key, rating):
+        """rating uses the same 1-10 scale as Trakt."""
+        self._request("PUT", "/:/rate", key=rating_key, identifier=LIBRARY_IDENTIFIER, rating=rating)
+
+    def close(self):
+        self.session.close()
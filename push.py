@@ -0,0 +1,336 @@
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import db
+import jobs
+import metrics
+from plex import PlexClient, external_ids, tvdb_id
+
+
+# ---------- PLEX HTTP API ----------
+def plex_client():
+    """PlexClient for the configured server, or None to use the Selenium path."""
+    if not (config.PLEX_URL and config.PLEX_TOKEN):
+        return None
+    return PlexClient(config.PLEX_URL, config.PLEX_TOKEN, pool_size=config.PLEX_WORKERS)
+
+
+def isKnownMiss(match, now, library_changed_at=0):
+    """True if a plex_match row says the film was missing and checking again is pointless."""
+    if not match or match[0]:
+        return False
+    checked_at = match[3]
+    return checked_at > library_changed_at and now - checked_at < config.PLEX_MISS_TTL
+
+
+def refreshPlexLibrary(plex, full=False):
+    """Mirror the Plex movie sections into plex_library.
+
+    After the first pass only items with a newer updatedAt are fetched. If the
+    section size then disagrees with our copy (something was removed) the
+    section is re-read in full.
+    """
+    conn = db.get_conn()
+    c = conn.cursor()
+
+    for section in plex.movie_sections():
+        key = section["key"]
+        state_key = f"plex_library.{key}.updated_at"
+        since = None if full else db.get_state(c, state_key)
+
+        # an incremental pass, then one full re-read if films went missing
+        for _ in range(2):
+            if since is None:
+                db.clear_plex_section(c, key)
+            newest = int(since or 0)
+            rows = []
+            for item in plex.section_movies(key, updated_since=since):
+                imdb_id, tmdb_id = external_ids(item)
+                updated_at = int(item.get("updatedAt", 0))
+                newest = max(newest, updated_at)
+                rows.append((item["ratingKey"], key, item.get("title"), item.get("year"),
+                             imdb_id, tmdb_id, updated_at))
+            db.upsert_plex_library(c, rows)
+            db.set_state(c, state_key, str(newest))
+            if rows:
+                # lets films cached as missing be looked up again
+                db.set_state(c, "plex_library.changed_at", str(int(time.time())))
+                db.forget_stale_plex_matches(c)
+            conn.commit()
+
+            if since is None or db.plex_section_count(c, key) == plex.section_size(key):
+                break
+            since = None
+        print(f"Plex section {section.get('title', key)}: indexed {len(rows)} changed movies")
+
+
+def plexViewState(plex):
+    """What Plex currently shows for every movie, rating_key -> dict with the
+    film's ids, whether it is watched (and when last), and its 1-10 rating.
+
+    Watching or rating doesn't bump updatedAt, so unlike refreshPlexLibrary
+    this always reads the sections in full (one request per 500 movies).
+    """
+    state = {}
+    for section in plex.movie_sections():
+        for item in plex.section_movies(section["key"]):
+            imdb_id, tmdb_id = external_ids(item)
+            rating = item.get("userRating")
+            state[item["ratingKey"]] = {
+                "imdb_id": imdb_id,
+                "tmdb_id": tmdb_id,
+                "title": item.get("title"),
+                "year": item.get("year"),
+                "watched": int(item.get("viewCount", 0)) > 0,
+                "last_viewed_at": item.get("lastViewedAt"),
+                "rating": int(round(float(rating))) if rating else None,
+            }
+    return state
+
+
+def pushFilmsToPlex(plex, films, action, workers=None, done=None):
+    """Run action(rating_key, film) for each film concurrently.
+
+    films are tuples starting with (slug, imdb_id, tmdb_id, title, year).
+    Films are matched through the local plex_library index by GUID; only
+    films without any external id fall back to a title search. done(rating_key,
+    film) says Plex already has it right, those films are counted as pushed
+    without a request.
+    Returns the films that were found in Plex and pushed successfully.
+    """
+    conn = db.get_conn()
+    c = conn.cursor()
+    now = int(time.time())
+    library_changed_at = int(db.get_state(c, "plex_library.changed_at", 0))
+    matched, lookups, skipped = [], [], 0
+    for film in films:
+        slug, imdb_id, tmdb_id, title, year = film[:5]
+        match = db.get_plex_match(c, slug)
+        if match and match[1] is not None:
+            matched.append((match[1], film))
+            continue
+        if isKnownMiss(match, now, library_changed_at):
+            skipped += 1
+            continue
+
+        if imdb_id or tmdb_id:
+            rating_key = db.plex_key_for(c, imdb_id, tmdb_id)
+        else:
+            rating_key = plex.find_movie(title, year)
+        lookups.append((slug, int(rating_key is not None), rating_key, None, now))
+        if rating_key is None:
+            print(f"No results found for {title} ({year})")
+            continue
+        matched.append((rating_key, film))
+    db.record_plex_matches(c, lookups)
+    conn.commit()
+    if skipped:
+        print(f"Skipped {skipped} films not in Plex since the last library change")
+
+    already = []
+    if done is not None:
+        todo = []
+        for rating_key, film in matched:
+            if done(rating_key, film):
+                already.append(film)
+            else:
+                todo.append((rating_key, film))
+        matched = todo
+        if already:
+            print(f"{len(already)} films already up to date in Plex")
+
+    pushed = pushMatched(matched, action, workers)
+    print(f"Pushed {len(pushed)}/{len(films)} films to Plex")
+    return already + pushed
+
+
+def filmTitle(film):
+    return f"{film[3]} ({film[4]})"
+
+
+def pushMatched(matched, action, workers=None, describe=filmTitle, unit="films"):
+    """Run action(rating_key, item) for each (rating_key, item) pair concurrently.
+
+    Items are film tuples unless describe(item), which names an item in the
+    log, says otherwise. Returns the items pushed successfully.
+    """
+    # pool threads aren't the job thread, so report through the job itself
+    job = jobs.current()
+    if job is not None:
+        job.progress(done=0, total=len(matched), message=unit)
+
+    def push_one(match):
+        rating_key, film = match
+        try:
+            action(rating_key, film)
+            if job is not None:
+                job.progress(advance=1)
+            return film
+        except Exception as e:
+            print(f"Could not push {describe(film)}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, workers or config.PLEX_WORKERS)) as pool:
+        return [film for film in pool.map(metrics.bind(push_one), matched) if film is not None]
+
+
+def setPlexWatchHistoryAPI(plex, state=None):
+    conn = db.get_conn()
+    c = conn.cursor()
+
+    films = db.films_not_in_plex(c)
+
+    # a scrobble adds another play, so films Plex already shows watched are left alone
+    state = plexViewState(plex) if state is None else state
+    pushed = pushFilmsToPlex(plex, films, lambda key, film: plex.mark_watched(key),
+                             done=lambda key, film: state.get(key, {}).get("watched", False))
+    db.mark_films_in_plex(c, [film[0] for film in pushed])
+    conn.commit()
+
+
+def setPlexWatchRatingAPI(plex, state=None):
+    conn = db.get_conn()
+    c = conn.cursor()
+
+    films = db.films_not_in_plex(c, ratings=True)
+
+    state = plexViewState(plex) if state is None else state
+    pushed = pushFilmsToPlex(plex, films, lambda key, film: plex.rate(key, film[5]),
+                             done=lambda key, film: state.get(key, {}).get("rating") == film[5])
+    db.mark_films_in_plex(c, [film[0] for film in pushed], ratings=True)
+    conn.commit()
+
+
+# ---------- EPISODES ----------
+def plexEpisodes(plex):
+    """Every episode in the Plex show sections.
+
+    Returns (shows, episodes, unwatched): ("tvdb"|"tmdb"|"imdb", id) -> show
+    ratingKey, (show ratingKey, season, number) -> (episode ratingKey, season
+    ratingKey, watched), and show or season ratingKey -> episodes Plex shows
+    unwatched in it, counting the unnumbered ones that can't be matched.
+    """
+    shows, episodes, unwatched = {}, {}, Counter()
+    for section in plex.show_sections():
+        for item in plex.section_shows(section["key"]):
+            imdb_id, tmdb_id = external_ids(item)
+            for guid in (("tvdb", tvdb_id(item)), ("tmdb", tmdb_id), ("imdb", imdb_id)):
+                if guid[1]:
+                    shows.setdefault(guid, item["ratingKey"])
+        for item in plex.section_episodes(section["key"]):
+            watched = int(item.get("viewCount", 0)) > 0
+            if not watched:
+                unwatched[item["grandparentRatingKey"]] += 1
+                if "parentRatingKey" in item:
+                    unwatched[item["parentRatingKey"]] += 1
+            if "parentIndex" not in item or "index" not in item:
+                continue  # specials without numbering can't be matched
+            episodes[(item["grandparentRatingKey"], int(item["parentIndex"]), int(item["index"]))] = (
+                item["ratingKey"], item["parentRatingKey"], watched)
+    return shows, episodes, unwatched
+
+
+def pushEpisodesToPlex(plex, workers=None):
+    """Mark every episode watched on Trakt as watched in Plex, in as few requests as possible.
+
+    Plex marks a whole show or season watched with one scrobble, so when every
+    episode Plex still shows unwatched in a show (or season) is one we're
+    pushing, that show (or season) goes in a single request; only the rest go
+    episode by episode. Episodes Plex already shows watched are only flagged.
+    """
+    conn = db.get_conn()
+    c = conn.cursor()
+    pending = db.episodes_not_in_plex(c)
+    if not pending:
+        print("No episodes waiting for Plex")
+        return
+
+    shows, episodes, unwatched = plexEpisodes(plex)
+
+    already, missing = [], 0
+    by_show = {}    # show ratingKey -> [(episode ratingKey, season ratingKey, row)]
+    for row in pending:
+        episode_id, tvdb, tmdb, imdb, title, season, number = row
+        show = next((shows[guid] for guid in (("tvdb", tvdb), ("tmdb", tmdb), ("imdb", imdb))
+                     if guid[1] and guid in shows), None)
+        found = episodes.get((show, season, number))
+        if found is None:
+            missing += 1
+            continue
+        rating_key, season_key, watched = found
+        if watched:
+            already.append(episode_id)
+        else:
+            by_show.setdefault(show, []).append((rating_key, season_key, row))
+
+    # (rating key, (episode ids, show title, label)) per request
+    matched = []
+    for show, items in by_show.items():
+        title = items[0][2][4]
+        if len(items) > 1 and len(items) == unwatched[show]:
+            matched.append((show, ([row[0] for _, _, row in items], title, "whole show")))
+            continue
+        by_season = {}
+        for rating_key, season_key, row in items:
+            by_season.setdefault(season_key, []).append((rating_key, row))
+        for season_key, season_items in by_season.items():
+            if len(season_items) > 1 and len(season_items) == unwatched[season_key]:
+                label = f"season {season_items[0][1][5]}"
+                matched.append((season_key, ([row[0] for _, row in season_items], title, label)))
+            else:
+                matched.extend((rating_key, ([row[0]], title, f"S{row[5]:02d}E{row[6]:02d}"))
+                               for rating_key, row in season_items)
+
+    pushed = pushMatched(matched, lambda key, request: plex.mark_watched(key), workers,
+                         describe=lambda request: f"{request[1]} {request[2]}", unit="episode requests")
+    marked = already + [episode_id for request in pushed for episode_id in request[0]]
+    db.mark_episodes_in_plex(c, marked)
+    conn.commit()
+
+    print(f"Episodes: {len(marked) - len(already)} marked watched in Plex with {len(pushed)} requests, "
+          f"{len(already)} already watched, {missing} not in Plex")
+    jobs.progress(message=f"{len(marked)} episodes in Plex, {missing} not in the library")
+
+
+PUSH_MODES = ("history", "ratings", "all", "episodes")
+
+
+def runPush(mode):
+    if mode not in PUSH_MODES:
+        raise ValueError(f"Unknown push mode {mode!r}, expected one of {', '.join(PUSH_MODES)}")
+    plex = plex_client()
+    if mode == "episodes":
+        if plex is None:
+            print("Pushing episodes needs Plex_URL and Plex_Token, the browser fallback only handles films")
+            return
+        try:
+            pushEpisodesToPlex(plex)
+        finally:
+            plex.close()
+        return
+
+    if plex is not None:
+        try:
+            refreshPlexLibrary(plex)
+            state = plexViewState(plex)
+            if mode in ("history", "all"):
+                setPlexWatchHistoryAPI(plex, state)
+            if mode in ("ratings", "all"):
+                setPlexWatchRatingAPI(plex, state)
+        finally:
+            plex.close()
+        return
+
+    # only the fallback needs Selenium, so it is imported here
+    import browser
+    with browser.pool().sessions() as drivers:
+        if mode == "history":
+            browser.setPlexWatchHistory(drivers)
+        elif mode == "ratings":
+            # browser.setPlexWatchRating(drivers[0])
+            pass
+        elif mode == "all":
+            # browser.setPlexWatchHistoryAndRating(drivers[0])
+            pass
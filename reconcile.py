@@ -0,0 +1,200 @@
+"""Two-way reconciliation of watched state and ratings between Trakt and Plex.
+
+Both sides are loaded whole and indexed by GUID (imdb://..., tmdb://...), the
+differences are set operations on those keys, and only the differences are
+sent: films watched or rated on Trakt but not in Plex go to Plex, plays and
+ratings made in Plex go back to Trakt. When both sides rated a film
+differently Trakt wins, as it does for the push. Films without an IMDb or
+TMDB id on either side can't be keyed and are left out.
+"""
+import datetime
+
+import db
+import jobs
+import push
+import sync
+
+# titles listed per difference in the report
+REPORT_EXAMPLES = 10
+
+
+def guids(imdb_id, tmdb_id):
+    """Every GUID a film goes by, IMDb first."""
+    keys = []
+    if imdb_id:
+        keys.append(f"imdb://{imdb_id}")
+    if tmdb_id:
+        keys.append(f"tmdb://{tmdb_id}")
+    return keys
+
+
+class GuidIndex:
+    """Films under one canonical GUID each, found by any GUID they carry."""
+
+    def __init__(self):
+        self.films = {}     # canonical guid -> film dict
+        self.aliases = {}   # any guid -> canonical guid
+
+    def add(self, imdb_id, tmdb_id, film):
+        """Index film, or return the key of the film already indexed under one of its GUIDs."""
+        keys = guids(imdb_id, tmdb_id)
+        if not keys:
+            return None
+        key = self.find(imdb_id, tmdb_id) or keys[0]
+        self.films.setdefault(key, film)
+        for guid in keys:
+            self.aliases.setdefault(guid, key)
+        return key
+
+    def find(self, imdb_id, tmdb_id):
+        for guid in guids(imdb_id, tmdb_id):
+            if guid in self.aliases:
+                return self.aliases[guid]
+        return None
+
+
+# ---------- LOAD ----------
+def traktIndex(trakt):
+    """Every film watched or rated on Trakt: two requests, both ETag cached."""
+    index = GuidIndex()
+    for path, watched in (("/sync/watched/movies", True), ("/sync/ratings/movies", False)):
+        _, items = trakt.stream(path, cached=True)
+        for item in items:
+            m = item["movie"]
+            ids = m["ids"]
+            key = index.add(ids.get("imdb"), ids.get("tmdb"), {
+                "imdb_id": ids.get("imdb"), "tmdb_id": ids.get("tmdb"),
+                "title": m.get("title"), "year": m.get("year"), "watched": watched, "rating": None,
+            })
+            if key is not None and "rating" in item:
+                index.films[key]["rating"] = item["rating"]
+    return index
+
+
+def plexIndex(state):
+    """The films of push.plexViewState(), by GUID."""
+    index = GuidIndex()
+    for rating_key, film in state.items():
+        index.add(film["imdb_id"], film["tmdb_id"], dict(film, rating_key=rating_key))
+    return index
+
+
+# ---------- DIFF ----------
+def diff(trakt_index, plex_index):
+    """What each side is missing, as lists of Plex films (Trakt films for not_in_plex)."""
+    # Trakt films under their Plex key, films Plex doesn't have drop out here
+    on_plex = {}
+    not_in_plex = []
+    for film in trakt_index.films.values():
+        key = plex_index.find(film["imdb_id"], film["tmdb_id"])
+        if key is not None:
+            on_plex[key] = film
+        elif film["watched"]:
+            not_in_plex.append(film)
+
+    trakt_watched = {key for key, film in on_plex.items() if film["watched"]}
+    trakt_rated = {key: film["rating"] for key, film in on_plex.items() if film["rating"]}
+    plex_watched = {key for key, film in plex_index.films.items() if film["watched"]}
+    plex_rated = {key: film["rating"] for key, film in plex_index.films.items() if film["rating"]}
+
+    def films(keys):
+        return [plex_index.films[key] for key in sorted(keys)]
+
+    return {
+        "plex_watched": films(trakt_watched - plex_watched),
+        "plex_ratings": [dict(plex_index.films[key], rating=rating)
+                         for key, rating in sorted(trakt_rated.items()) if plex_rated.get(key) != rating],
+        "trakt_history": films(plex_watched - trakt_watched),
+        "trakt_ratings": films(plex_rated.keys() - trakt_rated.keys()),
+        "not_in_plex": not_in_plex,
+        "in_sync": {"watched": len(trakt_watched & plex_watched),
+                    "ratings": sum(1 for key in trakt_rated if plex_rated.get(key) == trakt_rated[key])},
+    }
+
+
+def report(delta):
+    """Counts and a few example titles per difference, JSON friendly."""
+    summary = {"in_sync": delta["in_sync"]}
+    for name in ("plex_watched", "plex_ratings", "trakt_history", "trakt_ratings", "not_in_plex"):
+        films = delta[name]
+        summary[name] = {
+            "count": len(films),
+            "examples": [f"{film['title']} ({film['year']})" for film in films[:REPORT_EXAMPLES]],
+        }
+    return summary
+
+
+# ---------- APPLY ----------
+def traktIds(film):
+    return {name: value for name, value in (("imdb", film["imdb_id"]), ("tmdb", film["tmdb_id"])) if value}
+
+
+def viewedAt(timestamp):
+    """Plex lastViewedAt (epoch seconds) as a Trakt watched_at, None when unknown."""
+    if not timestamp:
+        return None
+    when = datetime.datetime.fromtimestamp(int(timestamp), datetime.timezone.utc)
+    return when.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def reconcile(plex, trakt, dry_run=False):
+    """Compare Trakt and Plex and send each side only what it is missing.
+
+    Returns the report, with what was actually sent added unless dry_run.
+    """
+    jobs.progress(message="loading Plex and Trakt state")
+    state = push.plexViewState(plex)
+    delta = diff(traktIndex(trakt), plexIndex(state))
+    summary = report(delta)
+    print("Reconcile: " + ", ".join(f"{name} {summary[name]['count']}" for name in summary if name != "in_sync"))
+    if dry_run:
+        jobs.progress(message="dry run, nothing sent")
+        return summary
+
+    # Trakt -> Plex, one request per film
+    def film_tuple(film):
+        return film["rating_key"], film["imdb_id"], film["tmdb_id"], film["title"], film["year"], film["rating"]
+
+    jobs.progress(message="marking watched in Plex")
+    watched = push.pushMatched([(film["rating_key"], film_tuple(film)) for film in delta["plex_watched"]],
+                               lambda key, film: plex.mark_watched(key))
+    for film in watched:
+        state[film[0]]["watched"] = True
+
+    jobs.progress(message="rating in Plex")
+    rated = push.pushMatched([(film["rating_key"], film_tuple(film)) for film in delta["plex_ratings"]],
+                             lambda key, film: plex.rate(key, film[5]))
+    for film in rated:
+        state[film[0]]["rating"] = film[5]
+
+    # Plex -> Trakt, batched
+    jobs.progress(message="adding Plex plays to Trakt")
+    plays = [{"ids": traktIds(film), "title": film["title"], "year": film["year"],
+              "watched_at": viewedAt(film["last_viewed_at"])} for film in delta["trakt_history"]]
+    added = sync.postMovies(trakt, "/sync/history", [{k: v for k, v in play.items() if v} for play in plays])
+    ratings = [{"ids": traktIds(film), "title": film["title"], "year": film["year"], "rating": film["rating"]}
+               for film in delta["trakt_ratings"]]
+    rated_on_trakt, _ = sync.submitRatings(trakt, ratings) if ratings else (0, 0)
+
+    # the push flags now follow what Plex shows
+    conn = db.get_conn()
+    db.apply_plex_state(conn.cursor(), [(film["imdb_id"], film["tmdb_id"], int(film["watched"]), film["rating"])
+                                        for film in state.values()])
+    conn.commit()
+
+    summary["sent"] = {"plex_watched": len(watched), "plex_ratings": len(rated),
+                       "trakt_history": len(added), "trakt_ratings": rated_on_trakt}
+    jobs.progress(message="{plex_watched} watched and {plex_ratings} rated in Plex, "
+                          "{trakt_history} plays and {trakt_ratings} ratings added to Trakt".format(**summary["sent"]))
+    return summary
+
+
+def runReconcile(trakt, dry_run=False):
+    """reconcile() against the configured Plex server, which the Selenium path can't do."""
+    plex = push.plex_client()
+    if plex is None:
+        raise RuntimeError("Reconciling needs Plex_URL and Plex_Token in API_KEYS.json")
+    try:
+        return reconcile(plex, trakt, dry_run=dry_run)
+    finally:
+        plex.close()
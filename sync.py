@@ -0,0 +1,412 @@
+import csv
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import db
+import jobs
+import metrics
+from http_cache import ResponseCache
+from pipeline import DBWriter, batched, ordered_map
+from trakt import TraktClient
+
+# ratings staged per write while the ratings list is still downloading
+RATING_BATCH = 1000
+# movies per POST to /sync/ratings or /sync/history
+POST_CHUNK = 250
+# IMDb "Title Type" values that are films
+IMDB_MOVIE_TYPES = {"movie", "tvmovie", "video"}
+
+_trakt = None
+_trakt_lock = threading.Lock()
+
+
+def trakt_client():
+    """The process-wide TraktClient, so every sync shares one pool and one rate limiter.
+
+    Credentials are read on first use; a token refreshed since then is
+    swapped into the running client.
+    """
+    global _trakt
+    token = config.trakt_token()
+    with _trakt_lock:
+        if _trakt is None:
+            cache = ResponseCache(max_bytes=config.TRAKT_CACHE_MB * 1024 * 1024)
+            _trakt = TraktClient(config.CLIENT_ID, token["access_token"],
+                                 pool_size=max(config.SYNC_WORKERS, 4), cache=cache)
+        else:
+            _trakt.set_access_token(token["access_token"])
+        return _trakt
+
+
+# ---------- SYNC FUNCTIONS ----------
+def fetchHistoryPage(trakt, page, per_page=100, start_at=None, kind="movies"):
+    """Stream one page of movie or episode history, returns (response headers, row iterator)."""
+    params = {"page": page, "limit": per_page}
+    if start_at:
+        params["start_at"] = start_at
+    resp_headers, items = trakt.stream(f"/sync/history/{kind}", cached=True, **params)
+    return resp_headers, HISTORY_KINDS[kind][0](items)
+
+
+def historyRows(items):
+    """Flatten Trakt history items into history table rows as they are parsed."""
+    for item in items:
+        m = item["movie"]
+        ids = m["ids"]
+        yield (
+            item["id"],  # history event id
+            ids.get("trakt"),
+            ids["slug"],
+            ids.get("imdb"),
+            ids.get("tmdb"),
+            m["title"],
+            m["year"],
+            item["watched_at"]
+        )
+
+
+def episodeRows(items):
+    """Flatten Trakt episode history items into (history_id, show, episode, watched_at) rows."""
+    for item in items:
+        show, episode = item["show"], item["episode"]
+        show_ids = show["ids"]
+        yield (
+            item["id"],
+            (show_ids["trakt"], show_ids["slug"], show["title"], show.get("year"),
+             show_ids.get("imdb"), show_ids.get("tmdb"), show_ids.get("tvdb")),
+            (episode["ids"]["trakt"], show_ids["trakt"], episode["season"], episode["number"], episode.get("title")),
+            toEpoch(item["watched_at"])
+        )
+
+
+def toEpoch(timestamp):
+    """Trakt timestamp (2014-03-31T09:28:53.000Z) as epoch seconds."""
+    when = datetime.datetime.fromisoformat(timestamp[:19]).replace(tzinfo=datetime.timezone.utc)
+    return int(when.timestamp())
+
+
+def fromEpoch(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+# row parser, bulk insert and sync_state key prefix per kind of history;
+# the inserts are looked up per call so wrappers around db (bench/run.py) see them
+HISTORY_KINDS = {
+    "movies": (historyRows, lambda c, rows: db.insert_history(c, rows), ""),
+    "episodes": (episodeRows, lambda c, rows: db.insert_episode_history(c, rows), "episodes."),
+}
+
+
+def writeHistoryPage(c, page, rows, kind="movies"):
+    """Insert one page of plays together with its checkpoint."""
+    _, insert, prefix = HISTORY_KINDS[kind]
+    insert(c, rows)
+    db.set_state(c, prefix + "full_import.page", str(page))
+
+
+def saveHistoryMark(c, kind="movies"):
+    """Persist the newest play we hold as the high-water mark for delta syncs."""
+    if kind == "episodes":
+        # no index on watched_at, a MAX over integers is cheap enough once per sync
+        c.execute("SELECT MAX(watched_at) FROM episode_watches")
+        newest = c.fetchone()[0]
+        if newest is not None:
+            db.set_state(c, "episodes.history_watched_at", fromEpoch(newest))
+        return
+    c.execute("SELECT watched_at, history_id FROM watches ORDER BY watched_at DESC, history_id DESC LIMIT 1")
+    row = c.fetchone()
+    if row:
+        db.set_state(c, "history_watched_at", row[0])
+        db.set_state(c, "history_id", str(row[1]))
+
+
+def fullImportState(c, kind="movies"):
+    """Checkpoint of the full history import: status, last committed page, page count."""
+    prefix = HISTORY_KINDS[kind][2]
+    return {
+        "status": db.get_state(c, prefix + "full_import.status", "none"),   # none | running | done
+        "page": int(db.get_state(c, prefix + "full_import.page", 0)),
+        "page_count": int(db.get_state(c, prefix + "full_import.page_count", 0)),
+    }
+
+
+def getAllHistory(trakt, workers=None, restart=False, kind="movies"):
+    """Fetch all Trakt history pages, not just recent watches.
+
+    Page 1 tells us the page count (X-Pagination-Page-Count), the rest are
+    fetched concurrently by up to `workers` threads sharing the client's
+    pooled session and rate limiter. Each fetch thread parses its page into
+    compact rows while it downloads; a single writer thread then commits
+    the pages in page order together with a checkpoint, so an interrupted
+    import picks up after the last committed page next time (unless
+    `restart`). New plays only push older ones onto later pages, so
+    resuming can re-read a few plays but never skips any.
+    """
+    per_page = 100
+    workers = workers or config.SYNC_WORKERS
+    _, insert, prefix = HISTORY_KINDS[kind]
+    c = db.get_conn().cursor()
+
+    checkpoint = fullImportState(c, kind)
+    resume_from = 1
+    if checkpoint["status"] == "running" and not restart:
+        resume_from = checkpoint["page"] + 1
+
+    with DBWriter() as writer:
+        # page 1 is always read: it carries the current page count
+        resp_headers, rows = fetchHistoryPage(trakt, 1, per_page, kind=kind)
+        page_count = int(resp_headers.get("X-Pagination-Page-Count", 1))
+        writer.put(insert, list(rows))
+        writer.put(db.set_state, prefix + "full_import.status", "running")
+        writer.put(db.set_state, prefix + "full_import.page_count", str(page_count))
+        writer.put(db.set_state, prefix + "full_import.page", str(max(resume_from - 1, 1)), commit=True)
+
+        start = max(resume_from, 2)
+        if resume_from > 1:
+            print(f"Resuming full {kind} history import at page {start} of {page_count}")
+        print(f"Trakt {kind} history: {page_count} pages, fetching with {workers} workers")
+        jobs.progress(done=start - 1, total=page_count, message="history pages")
+
+        if page_count >= start:
+            workers = max(1, workers)
+            pool = ThreadPoolExecutor(max_workers=workers)
+            try:
+                # results come back in page order, at most 2 pages per worker
+                # are held in memory waiting for the writer
+                pages = ordered_map(
+                    pool,
+                    metrics.bind(lambda p: (p, list(fetchHistoryPage(trakt, p, per_page, kind=kind)[1]))),
+                    range(start, page_count + 1),
+                    window=2 * workers
+                )
+                for page, rows in pages:
+                    writer.put(writeHistoryPage, page, rows, kind, commit=True)
+                    jobs.progress(done=page)
+            finally:
+                # on failure don't keep fetching pages nobody will write
+                pool.shutdown(wait=True, cancel_futures=True)
+
+        writer.put(saveHistoryMark, kind)
+        writer.put(db.set_state, prefix + "full_import.status", "done", commit=True)
+
+
+def getHistory(trakt, kind="movies"):
+    """Incremental sync: page through every play since the stored high-water mark.
+
+    Trakt treats start_at as inclusive, so the newest known play comes back
+    again and is dropped by INSERT OR IGNORE. With no mark yet this walks the
+    whole history once. Rows are handed to the writer in batches while the
+    rest of the page is still downloading.
+    """
+    per_page = 100
+    _, insert, prefix = HISTORY_KINDS[kind]
+    since = db.get_state(db.get_conn().cursor(), prefix + "history_watched_at")
+
+    with DBWriter() as writer:
+        page = 1
+        while True:
+            resp_headers, rows = fetchHistoryPage(trakt, page, per_page, start_at=since, kind=kind)
+            page_count = int(resp_headers.get("X-Pagination-Page-Count", 1))
+            count = 0
+            for batch in batched(rows, per_page):
+                writer.put(insert, batch)
+                count += len(batch)
+            jobs.progress(done=page, total=page_count, message="history pages")
+            if not count or page >= page_count:
+                break
+            page += 1
+
+        writer.put(saveHistoryMark, kind, commit=True)
+
+
+def getHistoryRating(trakt):
+    """Stream every movie rating into the staging table, then apply them in one UPDATE."""
+    resp_headers, items = trakt.stream("/sync/ratings/movies", cached=True)
+    jobs.progress(done=0, total=int(resp_headers.get("X-Pagination-Item-Count", 0)) or None, message="ratings")
+
+    ratings = ((item["movie"]["ids"]["slug"], item["rating"]) for item in items)
+    with DBWriter() as writer:
+        writer.put(db.stage_ratings, [], True)
+        for batch in batched(ratings, RATING_BATCH):
+            writer.put(db.stage_ratings, batch)
+            jobs.progress(advance=len(batch))
+        # the unrated queue follows along through the triggers on movies
+        writer.put(db.apply_staged_ratings, commit=True)
+
+
+# ---------- WRITES TO TRAKT ----------
+def movieKey(item):
+    """What Trakt echoes back in not_found: the best id we sent, else title and year."""
+    ids = item.get("ids") or {}
+    for name in ("trakt", "slug", "imdb", "tmdb"):
+        if ids.get(name):
+            return name, str(ids[name])
+    return "title", (item.get("title") or "").lower(), item.get("year")
+
+
+def postMovieChunk(trakt, path, chunk):
+    """POST one chunk of movie items, returns the items Trakt didn't report as not found."""
+    # a retried /sync/history POST that had gone through would add every play twice
+    resp = trakt.post(path, {"movies": chunk}, idempotent=path != "/sync/history").json()
+    missing = {movieKey(item) for item in (resp.get("not_found") or {}).get("movies", [])}
+    return [item for item in chunk if movieKey(item) not in missing]
+
+
+def postMovies(trakt, path, items, workers=None, accepted=None):
+    """POST movie items to a /sync endpoint in chunks, several at once but still
+    paced by the client's write limiter. Returns the items Trakt accepted.
+
+    A chunk that still fails after the client's retries doesn't stop the rest;
+    its error is raised once every chunk is answered, after the accepted items
+    were added to `accepted` (when given) so the caller can record them.
+    """
+    chunks = list(batched(items, POST_CHUNK))
+    workers = max(1, min(workers or config.SYNC_WORKERS, len(chunks) or 1))
+    jobs.progress(done=0, total=len(items))
+
+    def post(chunk):
+        try:
+            return postMovieChunk(trakt, path, chunk), None
+        except Exception as e:
+            return [], e
+
+    accepted = [] if accepted is None else accepted
+    error = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = ordered_map(pool, metrics.bind(post), chunks, window=2 * workers)
+        for chunk, (chunk_accepted, chunk_error) in zip(chunks, results):
+            accepted.extend(chunk_accepted)
+            error = error or chunk_error
+            jobs.progress(advance=len(chunk))
+    if error is not None:
+        raise error
+    return accepted
+
+
+def submitRatings(trakt, items, conn=None, workers=None):
+    """Send movie ratings to Trakt and record the accepted ones locally.
+
+    items are /sync/ratings movie objects (ids or title/year, rating, rated_at).
+    Once every chunk is answered the accepted ratings are applied in one
+    transaction, also when a chunk failed and its error is raised afterwards.
+    Returns (accepted, not_found) counts.
+    """
+    items = list(items)
+    jobs.progress(message=f"submitting {len(items)} ratings")
+    accepted = []
+    try:
+        postMovies(trakt, "/sync/ratings", items, workers, accepted=accepted)
+    finally:
+        conn = conn or db.get_conn()
+        rows = [(item.get("ids", {}).get("slug"), item.get("ids", {}).get("imdb"),
+                 item.get("title"), item.get("year"), item["rating"]) for item in accepted]
+        db.apply_rating_matches(conn.cursor(), rows)  # triggers drop them from unrated
+        conn.commit()
+
+    not_found = len(items) - len(accepted)
+    print(f"Submitted {len(items)} ratings: {len(accepted)} accepted, {not_found} not found on Trakt")
+    jobs.progress(message=f"{len(accepted)} rated, {not_found} not found on Trakt")
+    return len(accepted), not_found
+
+
+def readRatingsCSV(lines):
+    """Movie ratings from an IMDb or Letterboxd ratings export, as /sync/ratings items.
+
+    IMDb rows carry the IMDb id; Letterboxd rows only title and year, and their
+    half-star 0.5-5 scale is doubled onto Trakt's 1-10.
+    """
+    rows = csv.DictReader(lines)
+    fields = set(rows.fieldnames or ())
+    items = []
+    if {"Const", "Your Rating"} <= fields:
+        for row in rows:
+            kind = row.get("Title Type", "movie").replace(" ", "").lower()
+            if kind not in IMDB_MOVIE_TYPES or not row["Your Rating"]:
+                continue
+            items.append({
+                "ids": {"imdb": row["Const"]},
+                "title": row.get("Title"),
+                "year": int(row["Year"]) if row.get("Year") else None,
+                "rating": int(row["Your Rating"]),
+                "rated_at": csvDate(row.get("Date Rated")),
+            })
+    elif {"Name", "Year", "Rating"} <= fields:
+        for row in rows:
+            if not row["Rating"]:
+                continue
+            items.append({
+                "title": row["Name"],
+                "year": int(row["Year"]) if row["Year"] else None,
+                "rating": max(1, round(float(row["Rating"]) * 2)),
+                "rated_at": csvDate(row.get("Date")),
+            })
+    else:
+        raise ValueError("Not an IMDb or Letterboxd ratings export (expected Const/Your Rating "
+                         "or Name/Year/Rating columns)")
+    return [{k: v for k, v in item.items() if v is not None} for item in items]
+
+
+def csvDate(value):
+    """YYYY-MM-DD from an export as a Trakt timestamp, None when missing."""
+    return f"{value[:10]}T00:00:00.000Z" if value else None
+
+
+def getLastActivities(trakt):
+    """One small request that tells us when anything last changed on Trakt."""
+    return trakt.get("/sync/last_activities").json()
+
+
+# which last_activities timestamps (section, keys) each sync mode depends on
+SYNC_ACTIVITIES = {
+    "recent": ("movies", ("watched_at",)),
+    "full": ("movies", ("watched_at",)),
+    # a rating made before the film's first play synced is dropped (no movies row yet),
+    # so new plays have to make the next ratings sync run again
+    "ratings": ("movies", ("rated_at", "watched_at")),
+    "episodes": ("episodes", ("watched_at",)),
+    "episodes-full": ("episodes", ("watched_at",)),
+}
+
+# full imports and the incremental mode they bring up to date
+FULL_MODES = {"full": "recent", "episodes-full": "episodes"}
+
+
+def runSync(mode, trakt, force=False, restart=False):
+    """Run a sync mode unless Trakt reports nothing changed since the last run.
+
+    A full sync is an explicit request for everything, so it is never skipped;
+    it resumes an interrupted import unless `restart` is set.
+    Returns True if the sync actually ran.
+    """
+    sync_functions = {
+        "recent": getHistory,
+        "full": lambda trakt: getAllHistory(trakt, restart=restart),
+        "ratings": getHistoryRating,
+        "episodes": lambda trakt: getHistory(trakt, kind="episodes"),
+        "episodes-full": lambda trakt: getAllHistory(trakt, restart=restart, kind="episodes"),
+    }
+    if mode not in sync_functions:
+        return False
+
+    section, keys = SYNC_ACTIVITIES[mode]
+    activities = getLastActivities(trakt).get(section, {})
+    stamp = "|".join(activities.get(key) or "" for key in keys)
+    state_key = f"last_activities.{mode}"
+
+    conn = db.get_conn()
+    c = conn.cursor()
+    if not force and mode not in FULL_MODES and db.get_state(c, state_key) == stamp:
+        print(f"No Trakt activity since last {mode} sync, skipping")
+        jobs.progress(message="no Trakt activity, skipped")
+        return False
+
+    sync_functions[mode](trakt)
+
+    # record the stamp read *before* syncing so changes made meanwhile are picked up next time
+    db.set_state(c, state_key, stamp)
+    if mode in FULL_MODES:
+        db.set_state(c, f"last_activities.{FULL_MODES[mode]}", stamp)
+    conn.commit()
+    return True
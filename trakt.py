@@ -0,0 +1,243 @@
+import datetime
+import json
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+import metrics
+from pipeline import iter_json_array
+
+TRAKT_API = "https://api.trakt.tv"
+
+# Trakt's documented limits: authed GETs 1000 per 5 minutes, writes 1 per second
+GET_RATE = 1000 / 300
+WRITE_RATE = 1.0
+
+RETRY_STATUSES = (429, 500, 502, 503, 504, 520, 521, 522)
+# a 429 is refused before Trakt applies anything, so even non-idempotent writes may retry it
+UNSENT_STATUSES = (429,)
+
+
+def trakt_headers(client_id, access_token):
+    return {
+        "Content-Type": "application/json",
+        "trakt-api-version": "2",
+        "trakt-api-key": client_id,
+        "Authorization": f"Bearer {access_token}"
+    }
+
+
+class TokenBucket:
+    """Thread-safe token bucket. acquire() blocks until a request may go out."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.default_rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    self.tokens = min(self.tokens, 1)
+                    wait = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            metrics.sleep(wait, "trakt.rate_limit_wait")
+
+    def block_for(self, seconds):
+        """Hold every caller back, e.g. for a Retry-After."""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            # one request may go out when the block ends, no burst
+            self.tokens = min(self.tokens, 1)
+
+    def pace(self, remaining, seconds_left):
+        """Spread the calls Trakt says we have left over the rest of its window."""
+        with self._lock:
+            if seconds_left <= 0:
+                self.rate = self.default_rate
+            else:
+                self.rate = min(self.default_rate, max(remaining, 1) / seconds_left)
+
+
+class TraktClient:
+    """Shared Trakt API client: pooled connections, rate limiting and retries.
+
+    Safe to use from several threads at once; every thread draws from the
+    same token buckets so parallel syncs stay under Trakt's limits together.
+    """
+
+    def __init__(self, client_id, access_token, base_url=TRAKT_API, pool_size=8,
+                 max_retries=5, backoff=1.0, max_backoff=60.0, timeout=30, cache=None):
+        self.base_url = base_url.rstrip("/")
+        self.cache = cache
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(trakt_headers(client_id, access_token))
+        self.get_bucket = TokenBucket(GET_RATE, capacity=20)
+        self.write_bucket = TokenBucket(WRITE_RATE, capacity=1)
+
+    def set_access_token(self, access_token):
+        """Use a refreshed OAuth token for every later request."""
+        self.session.headers["Authorization"] = f"Bearer {access_token}"
+
+    def get(self, path, cached=False, **params):
+        """GET a path. With cached=True and a cache configured the request is
+        conditional and an unchanged (304) response is served from the cache."""
+        if not cached or self.cache is None:
+            return self.request("GET", path, params=params)
+        url = self.base_url + path
+        key = self.cache.key(url, params, self.session.headers.get("Authorization", ""))
+        entry = self.cache.lookup(key)
+        r = self.request("GET", path, params=params, headers=self.cache.validators(entry))
+        if r.status_code == 304 and entry is not None:
+            return self.cache.hit(key, entry, r)
+        self.cache.misses += 1
+        self.cache.store(key, r)
+        return r
+
+    def stream(self, path, cached=False, **params):
+        """GET a JSON array as (headers, items) with items parsed while downloading.
+
+        Same conditional caching as get(); a streamed body is only buffered for
+        the cache while it stays under the cache's per-entry limit.
+        """
+        key = entry = None
+        headers = {}
+        if cached and self.cache is not None:
+            key = self.cache.key(self.base_url + path, params, self.session.headers.get("Authorization", ""))
+            entry = self.cache.lookup(key)
+            headers = self.cache.validators(entry)
+        r = self.request("GET", path, params=params, headers=headers, stream=True)
+        if r.status_code == 304 and entry is not None:
+            r.close()
+            hit = self.cache.hit(key, entry, r)
+            return hit.headers, iter_json_array([hit.content])
+        if key is not None:
+            self.cache.misses += 1
+        return r.headers, self._stream_items(r, key if key is not None and self.cache.cacheable(r) else None)
+
+    def _stream_items(self, r, cache_key):
+        body, size = ([] if cache_key else None), 0
+
+        def chunks():
+            nonlocal body, size
+            for chunk in r.iter_content(64 * 1024):
+                if body is not None:
+                    size += len(chunk)
+                    if size <= self.cache.max_entry_bytes:
+                        body.append(chunk)
+                    else:
+                        body = None  # too big to cache, stop buffering
+                yield chunk
+
+        try:
+            yield from iter_json_array(chunks())
+            if body is not None:
+                self.cache.store(cache_key, r, b"".join(body))
+        finally:
+            r.close()
+
+    def post(self, path, payload, idempotent=True):
+        return self.request("POST", path, payload=payload, idempotent=idempotent)
+
+    def request(self, method, path, params=None, payload=None, headers=None, stream=False, idempotent=True):
+        """Send a request with rate limiting and retries. With idempotent=False only
+        failures Trakt can't have acted on are retried: a 429 or a refused connection."""
+        retry_statuses = RETRY_STATUSES if idempotent else UNSENT_STATUSES
+        bucket = self.get_bucket if method == "GET" else self.write_bucket
+        url = self.base_url + path
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire()
+            try:
+                with metrics.span("trakt.request"):
+                    r = self.session.request(method, url, params=params, json=payload,
+                                             headers=headers, stream=stream, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.inc("trakt_responses_total", status="error")
+                if attempt == self.max_retries or not (idempotent or self._not_sent(e)):
+                    raise
+                delay = self._backoff(attempt)
+                print(f"Trakt {method} {path} failed ({e}), retrying in {delay:.1f}s")
+                metrics.sleep(delay, "trakt.backoff")
+                continue
+
+            metrics.inc("trakt_responses_total", status=r.status_code)
+            self._observe(r, bucket)
+            if r.status_code == 420:
+                raise RuntimeError("Trakt account limit exceeded (420), check your list/item counts")
+            if r.status_code in retry_statuses and attempt < self.max_retries:
+                delay = self._retry_after(r) or self._backoff(attempt)
+                print(f"Trakt {method} {path} returned {r.status_code}, retrying in {delay:.1f}s")
+                r.close()
+                bucket.block_for(delay)
+                continue
+            r.raise_for_status()
+            return r
+
+    def _backoff(self, attempt):
+        """Exponential backoff with full jitter."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    @staticmethod
+    def _not_sent(e):
+        """True when the request never reached Trakt: the connection was refused or timed out."""
+        if isinstance(e, requests.ConnectTimeout):
+            return True
+        reason = getattr(e.args[0], "reason", None) if e.args else None
+        return isinstance(reason, NewConnectionError)
+
+    @staticmethod
+    def _retry_after(r):
+        value = r.headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _observe(r, bucket):
+        """Adapt pacing to the X-Ratelimit header Trakt sends with each response."""
+        header = r.headers.get("X-Ratelimit")
+        if not header:
+            return
+        try:
+            limit = json.loads(header)
+            until = datetime.datetime.fromisoformat(limit["until"].replace("Z", "+00:00"))
+            seconds_left = (until - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+            remaining = int(limit["remaining"])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return
+        if remaining <= 0 and seconds_left > 0:
+            bucket.block_for(seconds_left)
+        else:
+            bucket.pace(remaining, seconds_left)
+
+    def close(self):
+        self.session.close()